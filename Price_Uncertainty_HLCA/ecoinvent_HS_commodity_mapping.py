@@ -1,12 +1,13 @@
-import fnmatch
 import pandas as pd
 import os
 import numpy as np
 import json
+from .instrumentation import get_instrumentation
 
 
 
-def ecoHS12_dic(concordance_file_path, PRO, save_dir=None, dict_name=None):
+def ecoHS12_dic(concordance_file_path, PRO, save_dir=None, dict_name=None,
+                instrumentation=None):
     """Function maps ecoinvent processes to HS commodities based on cpc21-HS12
     concordance.
     Inputs
@@ -22,28 +23,39 @@ def ecoHS12_dic(concordance_file_path, PRO, save_dir=None, dict_name=None):
 
     dict_name                 file name for the json file. If None, dict will
                               not be saved.
+
+    instrumentation           Instrumentation that receives the messages and
+                              collects the time and memory of the stages
+                              'HS12/read concordance' and 'HS12/map'
+                              (activities/s),
+                              see instrumentation.Instrumentation. False
+                              silences all messages. Default: None, i.e.
+                              print the messages
     """
+    ins = get_instrumentation(instrumentation)
 
-    cpc21_hs12 = pd.read_csv(concordance_file_path, header=0, dtype='str')
-    cpc21_hs12['HS12code'] = cpc21_hs12['HS12code'].str.replace('.','')
+    with ins.stage('HS12/read concordance'):
+        cpc21_hs12 = pd.read_csv(concordance_file_path, header=0, dtype='str')
+        cpc21_hs12['HS12code'] = cpc21_hs12['HS12code'].str.replace('.','')
 
-    cpc_codes = PRO['cpc'].str.split(':').str.get(0)
-    
-    eco_hs12_mapping_dic, _ = create_dict_ecoinvent_HS12(cpc21_hs12,
-                                    PRO.index, cpc_codes)
+    with ins.stage('HS12/map') as stage:
+        cpc_codes = PRO['cpc'].str.split(':').str.get(0)
+        eco_hs12_mapping_dic, _ = create_dict_ecoinvent_HS12(cpc21_hs12,
+                                        PRO.index, cpc_codes, log=ins.log)
+        stage.count(len(PRO), 'activities')
 
     if dict_name==None:
-        print('No Path and Filename provided. Not saving the dictionary.')
+        ins.log('No Path and Filename provided. Not saving the dictionary.')
         return eco_hs12_mapping_dic
     else:
         if save_dir==None:
-            print('No Path to save File specified, saving in current wd.')
+            ins.log('No Path to save File specified, saving in current wd.')
             save_dir = os.getcwd()
         save_dir = os.path.realpath(save_dir)
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
         filePath = os.path.join(save_dir,'ecoinvent35-HS12_mapping.json')
-        print("Saving dictionary to: '{}'".format(filePath))
+        ins.log("Saving dictionary to: '{}'".format(filePath))
         with open(filePath, 'w') as fh:
             json.dump(eco_hs12_mapping_dic, fh)
         return eco_hs12_mapping_dic
@@ -51,42 +63,76 @@ def ecoHS12_dic(concordance_file_path, PRO, save_dir=None, dict_name=None):
 
 
 
-def create_dict_ecoinvent_HS12(cpc21_hs12, UUIDs, cpc_codes):
+def create_dict_ecoinvent_HS12(cpc21_hs12, UUIDs, cpc_codes, log=print):
     """
     Create a dictionanry between the ecoinvent process_referenceProduct UUID
     and the matching HS codes if existend.
     Input:
     cpc21_hs12       A dataframe of the concordance file cpc21-hs12
-    PRO              A dataframe with the ecoinvent process data as defined pylcaio
+    UUIDs            The process UUID's (index of PRO)
+    cpc_codes        The cpc codes of the processes (without the name)
     
     Output           A dictionary with the process UUID's as keys, and the matching
-                     HS codes as a list of string(s) as values.
-    Depends on:
-    
-    - fnmatch
+                     HS codes as a list of string(s) as values, and an array
+                     with the lengths of the cpc codes.
+    Every distinct cpc code is looked up only once, see CPCPrefixIndex.
     """
-    len_codes = np.zeros(len(UUIDs))
+    cpc_codes = pd.Series(np.asarray(cpc_codes, dtype=object), index=UUIDs)
+    # all numbers starting with >=5 are services and not present in HS
+    goods = cpc_codes.str.match('[0-4]').fillna(False).astype(bool)
+    len_codes = np.where(goods, cpc_codes.str.len(), 0).astype('float64')
+
+    index = CPCPrefixIndex(cpc21_hs12)
+    hs12_codes = {code: index.lookup(code) for code in cpc_codes[goods].unique()}
     eco_hs12_mapping_dic = {}
-    for i,(index, code) in enumerate(zip(UUIDs, cpc_codes)):
-        # all numbers starting with >=5 are services and not present in HS
-        if code != None and int(code[0]) <= 4:
-            l = len(code)
-            len_codes[i] = l
-            if l == 5:
-                try:
-                    eco_hs12_mapping_dic[index] = cpc21_hs12.set_index('CPC21code').loc[code, 'HS12code'].unique().tolist()
-                except AttributeError:  # only 1 match,
-                    eco_hs12_mapping_dic[index] = [cpc21_hs12.set_index('CPC21code').loc[code, 'HS12code']]
-                except KeyError:
-                    print(l, index, code)
-            else:
-                # only section (1 digit) group (3 digits) or class (4digits) have been given.
-                # Use wilde card to match. 
-                cpc_codes = fnmatch.filter(cpc21_hs12['CPC21code'].tolist(),code+'*')
-                try:
-                    eco_hs12_mapping_dic[index] = cpc21_hs12.set_index('CPC21code').loc[cpc_codes, 'HS12code'].unique().tolist()
-                except KeyError:
-                    print(l, index, code)
+    for uuid, code, good in zip(UUIDs, cpc_codes.values, goods.values):
+        if not good:
+            eco_hs12_mapping_dic[uuid] = None
+        elif hs12_codes[code] is not None:
+            eco_hs12_mapping_dic[uuid] = hs12_codes[code]
         else:
-            eco_hs12_mapping_dic[index] = None
+            log('{} {} {}'.format(len(code), uuid, code))
     return eco_hs12_mapping_dic, len_codes
+
+
+class CPCPrefixIndex:
+    """Index of the cpc21-hs12 concordance for lookups of the HS codes of a
+    full cpc code or of a cpc code prefix. The concordance rows are sorted by
+    cpc code once, so every lookup is a range query with two binary searches.
+    Results are memoized per cpc code.
+    Input:
+    cpc21_hs12       A dataframe of the concordance file cpc21-hs12
+    """
+    def __init__(self, cpc21_hs12):
+        codes = cpc21_hs12['CPC21code'].to_numpy(dtype=str)
+        order = np.argsort(codes, kind='stable')
+        self.codes = codes[order]
+        self.hs12_codes = cpc21_hs12['HS12code'].to_numpy(dtype=object)[order]
+        # The HS codes of a prefix are listed in order of the first
+        # appearance of their cpc code in the concordance file
+        _, first, inverse = np.unique(codes, return_index=True,
+                                      return_inverse=True)
+        self.first = first[inverse.ravel()][order]
+        self.cache = {}
+
+    def lookup(self, code):
+        """Returns the list of unique HS codes for a 5 digit cpc code (None if
+        it is not in the concordance), or for all cpc codes starting with a
+        shorter section (1 digit), group (3 digits) or class (4 digits)
+        code."""
+        if code not in self.cache:
+            self.cache[code] = self._lookup(code)
+        return self.cache[code]
+
+    def _lookup(self, code):
+        start = np.searchsorted(self.codes, code, side='left')
+        if len(code) == 5:
+            stop = np.searchsorted(self.codes, code, side='right')
+            if stop == start:
+                return None
+            return pd.unique(self.hs12_codes[start:stop]).tolist()
+        # Use the prefix as wild card
+        stop = np.searchsorted(self.codes, code + chr(0x10ffff), side='left')
+        rows = np.arange(start, stop)
+        rows = rows[np.argsort(self.first[rows], kind='stable')]
+        return pd.unique(self.hs12_codes[rows]).tolist()
@@ -0,0 +1,171 @@
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+
+
+def print_progress(event):
+    """Default progress callback, prints the message of every event."""
+    print(event['message'])
+
+
+class Instrumentation:
+    """Progress reporting, per-stage wall time and memory and throughput
+    counters shared by do_price_MC, Match_BACI_data_to_ecoinvent,
+    make_price_df and ecoHS12_dic. Pass one instance to these functions and
+    read the collected numbers with summary() afterwards.
+    Every message goes to the progress callback as an event dictionary with
+    at least 'message', 'stage' and 'time' (seconds since the instance was
+    made), and 'done' and 'total' for progress updates. Use
+    Instrumentation(progress=None) to collect the numbers silently, or pass
+    instrumentation=False to the functions to switch everything off.
+    Input:
+    progress        Callback called with every event. Default: print_progress
+    track_memory    If True, the peak memory of every stage is traced with
+                    tracemalloc ('peak_traced_mb'), which slows down Python
+                    code. Otherwise only the peak resident memory of the
+                    process at the end of the stage is recorded
+                    ('max_rss_mb'). Default: False
+    """
+    enabled = True
+
+    def __init__(self, progress=print_progress, track_memory=False):
+        self.callback = progress
+        self.track_memory = track_memory
+        self.t0 = time.perf_counter()
+        self.stages = {}
+        self._stack = []
+
+    def log(self, message, **info):
+        """Reports a message from the current stage."""
+        if self.callback is not None:
+            event = {'message': message,
+                     'stage': self._stack[-1].name if self._stack else None,
+                     'time': time.perf_counter() - self.t0}
+            event.update(info)
+            self.callback(event)
+
+    def progress(self, done, total, unit='', **info):
+        """Reports that 'done' of 'total' items of the current stage are done."""
+        if self.callback is not None:
+            self.log('{} {} of total {}'.format(unit, done, total).strip(),
+                     done=done, total=total, unit=unit, **info)
+
+    def stage(self, name):
+        """Context manager measuring the stage 'name'. Returns the Stage,
+        whose count() method adds to the throughput counters. Stages can be
+        nested and the numbers of repeated stages are accumulated."""
+        return Stage(self, name)
+
+    def count(self, n, unit):
+        """Adds n items of 'unit' (e.g. 'runs', 'rows scanned') to the
+        current stage."""
+        if self._stack:
+            self._stack[-1].count(n, unit)
+
+    def summary(self):
+        """Returns a dictionary with per stage the number of 'calls', the
+        'seconds', the memory and the counters with their throughput per
+        second (e.g. 'runs' and 'runs/s')."""
+        summary = {}
+        for name, stage in self.stages.items():
+            entry = dict(stage)
+            for unit, n in stage['counts'].items():
+                entry[unit] = n
+                if stage['seconds'] > 0:
+                    entry['{}/s'.format(unit)] = n/stage['seconds']
+            del entry['counts']
+            summary[name] = entry
+        return summary
+
+
+class NullInstrumentation(Instrumentation):
+    """Instrumentation that does nothing, at near-zero cost."""
+    enabled = False
+
+    def __init__(self):
+        self.callback = None
+        self.stages = {}
+
+    def log(self, message, **info):
+        pass
+
+    def progress(self, done, total, unit='', **info):
+        pass
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, n, unit):
+        pass
+
+
+class Stage:
+    """A running stage of an Instrumentation, see Instrumentation.stage."""
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        ins = self.instrumentation
+        self.entry = ins.stages.setdefault(
+                self.name, {'calls': 0, 'seconds': 0., 'counts': {}})
+        self.entry['calls'] += 1
+        self.started_tracing = ins.track_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        elif ins.track_memory and not ins._stack:
+            tracemalloc.reset_peak()
+        ins._stack.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        ins = self.instrumentation
+        self.entry['seconds'] += time.perf_counter() - self.t0
+        ins._stack.pop()
+        if ins.track_memory:
+            peak = tracemalloc.get_traced_memory()[1]/2**20
+            self.entry['peak_traced_mb'] = max(
+                    self.entry.get('peak_traced_mb', 0.), peak)
+            if self.started_tracing:
+                tracemalloc.stop()
+        if resource is not None:
+            # ru_maxrss is in kB on Linux
+            self.entry['max_rss_mb'] = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss/2**10
+        return False
+
+    def count(self, n, unit):
+        counts = self.entry['counts']
+        counts[unit] = counts.get(unit, 0) + n
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, n, unit):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+_NULL = NullInstrumentation()
+
+
+def get_instrumentation(instrumentation=None):
+    """Returns the Instrumentation to use for the 'instrumentation' argument
+    of the pipeline functions: a new printing Instrumentation if None, a
+    NullInstrumentation if False, else the given instance."""
+    if instrumentation is None:
+        return Instrumentation()
+    if instrumentation is False:
+        return _NULL
+    return instrumentation
@@ -3,7 +3,7 @@ import numpy as np
 import pickle
 import warnings
 import os
-import scipy.stats as stats
+from .instrumentation import get_instrumentation
 
 
 
@@ -12,7 +12,8 @@ import scipy.stats as stats
 
 
 def make_price_df(PRO, price_data_dir, hybridized_processes, 
-                  outputFileName, outputDir=None, var_dic=None):
+                  outputFileName, outputDir=None, var_dic=None, seed=1,
+                  instrumentation=None):
     """
     Inputs:
     PRO                     DataFrame with metadata of processes. This is the
@@ -38,15 +39,26 @@ def make_price_df(PRO, price_data_dir, hybridized_processes,
                              'c_other': 1.05
                              }
                             See paper where these numbers come from.
+    seed                    Seed for the lognormal samples of the activities
+                            without BACI price info, see update_price_data.
+                            Default: 1
+    instrumentation         Instrumentation that receives the messages and
+                            collects the time and memory of the stages
+                            'price_df/read BACI prices', 'price_df/model
+                            variance' and 'price_df/write', see
+                            instrumentation.Instrumentation. False
+                            silences all messages. Default: None, i.e. print
+                            the messages
 
     """
+    ins = get_instrumentation(instrumentation)
 
     if outputDir==None:
         warnings.warn("No output directory given, using price_data_dir...")
         outputDir = os.path.realpath(price_data_dir)
 
     if var_dic==None:
-        print("No specific variance dictionary given. Using the default:\
+        ins.log("No specific variance dictionary given. Using the default:\
                 {'c_elec': 0.27, 'c_heat': 0.27, 'c_construction': 1.05,\
                  'c_freight': 0.44, 'c_finance': 1.05, 'c_services': 1.05,\
                  'c_waste': 1.05, 'c_other': 1.05}")
@@ -60,34 +72,37 @@ def make_price_df(PRO, price_data_dir, hybridized_processes,
                    'c_other': 1.05
                    }
 
-    for index in PRO.index.values:
-        if PRO.loc[index, 'priceless_scale_vector'] > 0:
-            PRO.loc[index,'effective_price'] = PRO.loc[index, 'priceless_scale_vector']
-        else:
-            PRO.loc[index,'effective_price'] = PRO.loc[index, 'price']
+    PRO['effective_price'] = np.where(PRO['priceless_scale_vector'] > 0,
+                                      PRO['priceless_scale_vector'],
+                                      PRO['price'])
 
     # Read in BACI price data
-    price_data, acts_with_baci_price = read_BACI_price_data(PRO, price_data_dir)
+    with ins.stage('price_df/read BACI prices') as stage:
+        price_data, acts_with_baci_price = read_BACI_price_data(PRO, price_data_dir)
+        stage.count(len(acts_with_baci_price), 'activities')
 
     # Model processes without a BACI price distribution with a lognormal around
     # the default price:
-    price_data = model_variance_per_category(price_data, PRO,
-                                             acts_with_baci_price, var_dic,
-                                             hybridized_processes)
+    with ins.stage('price_df/model variance') as stage:
+        price_data = model_variance_per_category(price_data, PRO,
+                                                 acts_with_baci_price, var_dic,
+                                                 hybridized_processes, seed)
+        stage.count(len(hybridized_processes), 'activities')
 
     # Check if outDir exists and if not make it.
     outputDir = os.path.realpath(outputDir)
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
-        print('Created the output directory {}'.format(outputDir))
+        ins.log('Created the output directory {}'.format(outputDir))
 
     # Save as feather file:
-    price_data.reset_index(inplace=True)  # Feather does not allow for index column so make it a normal column
-    price_data.columns = price_data.columns.astype(str)
-    filePath = os.path.join(outputDir, outputFileName)
-    price_data.to_feather(filePath)
+    with ins.stage('price_df/write'):
+        price_data.reset_index(inplace=True)  # Feather does not allow for index column so make it a normal column
+        price_data.columns = price_data.columns.astype(str)
+        filePath = os.path.join(outputDir, outputFileName)
+        price_data.to_feather(filePath)
 
-    print('Price DataFrame saved as feather file to {}'.format(filePath))
+    ins.log('Price DataFrame saved as feather file to {}'.format(filePath))
 
 
 def read_BACI_price_data(PRO, price_data_path):
@@ -97,116 +112,98 @@ def read_BACI_price_data(PRO, price_data_path):
     The indices of the data frame are the same as PRO i.e. the UUID's of the
     ecoinvent processes. Processes that do not have a BACI price dist have
     the 'effective_price' from the PRO meta data df.
+    If price_data_path holds the consolidated output of the matcher
+    ('baci_price_samples.npy' and 'baci_price_summary.ftr'), that is read in
+    one go instead of the pickle files.
     """
-    processlist = [x.split('.')[0] for x in os.listdir(price_data_path) if x.endswith('.pickle')]
-    # read the first pickle to determine the size of the distribution sample
-    with open(os.path.join(price_data_path, '{}.pickle'.format(processlist[0])), 'rb') as fh:
-        procdic = pickle.load(fh)
-        n_samples = len(procdic['price_sample'])
-    # Make df of appropriate size (N_acts, N_samples) with default prices
-    price_data = pd.DataFrame(index=PRO.index, data = np.ones((len(PRO.index), n_samples)))
-    price_data = price_data.multiply(PRO['effective_price'], axis='index')
-    # n_flows = []
-    # price_data_dic = {}
-    for i,proc in enumerate(processlist):
-        with open(os.path.join(price_data_path, '{}.pickle'.format(proc)), 'rb') as fh:
-            procdic = pickle.load(fh)
-            price_data.loc[proc] = procdic['price_sample']
-            # n_flows.append(procdic['nr_baci_flows'])
-            # price_data_dic[proc] = {'prices':procdic['prices_euro'], 'weights':procdic['weights'], 'nflows':procdic['nr_baci_flows']}
-    # n_flows = np.array(n_flows)
+    samples_file = os.path.join(price_data_path, 'baci_price_samples.npy')
+    summary_file = os.path.join(price_data_path, 'baci_price_summary.ftr')
+    if os.path.isfile(samples_file) and os.path.isfile(summary_file):
+        samples = np.load(samples_file)
+        processlist = pd.read_feather(summary_file, columns=['index'])['index'].tolist()
+    else:
+        processlist = [x.split('.')[0] for x in os.listdir(price_data_path) if x.endswith('.pickle')]
+        samples = []
+        for proc in processlist:
+            with open(os.path.join(price_data_path, '{}.pickle'.format(proc)), 'rb') as fh:
+                samples.append(pickle.load(fh)['price_sample'])
+        samples = np.stack(samples)
+    n_samples = samples.shape[1]
+    # Make array of appropriate size (N_acts, N_samples) with default prices
+    data = np.repeat(PRO['effective_price'].to_numpy(dtype='float64')[:, None],
+                     n_samples, axis=1)
+    positions = PRO.index.get_indexer(processlist)
+    if (positions < 0).any():
+        warnings.warn("{} processes with BACI price data are not in PRO".format(
+            (positions < 0).sum()))
+    data[positions[positions >= 0]] = samples[positions >= 0]
+    price_data = pd.DataFrame(index=PRO.index, data=data)
     return price_data, processlist
 
 
 def model_variance_per_category(price_data, PRO, processlist, var_dic,
-                                hybridized_processes):
+                                hybridized_processes, seed=1):
     """Models price distributions for activities without a baci price dist with
     lognormal distributions with a width specified by the var_dic. Returns an
     updated price_data data frame.
     """
-    hybrid_processes_without_baci_price = [x for x in
-            hybridized_processes if not x in processlist]
-
-    processes_with_proxy_data = []
-
-    # Electricity Processes cpc 'electrical energy' (cpc 17100)
-    elec_indices = PRO.loc[hybrid_processes_without_baci_price][
-                        PRO.loc[hybrid_processes_without_baci_price,'cpc'
-                        ].str.split(':').str.get(0) == '17100'].index
-    price_data, processes_with_proxy_data = update_price_data(price_data,
-                            elec_indices, var_dic['c_elec'],
-                            processes_with_proxy_data)
-
-    # Steam and Hot Water, often from 'heat and power cogeneration' (cpc 17300)
-    heat_indices = PRO.loc[hybrid_processes_without_baci_price][
-                        PRO.loc[hybrid_processes_without_baci_price,'cpc'
-                        ].str.split(':').str.get(0) == '17300'].index
-    price_data, processes_with_proxy_data = update_price_data(price_data,
-                            heat_indices, var_dic['c_heat'],
-                            processes_with_proxy_data)
-
-    # Construction work (cpc code that starts with 5)
-    construction_indices = [i[0] for i in
-                    PRO.loc[hybrid_processes_without_baci_price].iterrows()
-                    if i[1].cpc!= None and i[1].cpc.split(':')[0][0] in ['5']]
-    price_data, processes_with_proxy_data = update_price_data(price_data,
-                            construction_indices, var_dic['c_construction'],
-                            processes_with_proxy_data)
-
-    # Freight transport (cpc code that starts with 6)
-    freight_indices = [i[0] for i in
-                    PRO.loc[hybrid_processes_without_baci_price].iterrows()
-                    if i[1].cpc!= None and i[1].cpc.split(':')[0][0] in ['6']]
-    price_data, processes_with_proxy_data = update_price_data(price_data,
-                            freight_indices, var_dic['c_freight'],
-                            processes_with_proxy_data)
-
-    # Financial related services (cpc code that starts with 7)
-    finance_indices = [i[0] for i in
-                    PRO.loc[hybrid_processes_without_baci_price].iterrows()
-                    if i[1].cpc!= None and i[1].cpc.split(':')[0][0] in ['7']]
-    # So far these service are not included in ecoinvent or are not hybridised, 
-    # so check if they exist
-    if finance_indices != []:
-        price_data, processes_with_proxy_data = update_price_data(price_data,
-                            finance_indices, var_dic['c_finance'],
-                            processes_with_proxy_data)
-
-    # Services (cpc code that starts with 8)
-    services_indices = [i[0] for i in
-                    PRO.loc[hybrid_processes_without_baci_price].iterrows()
-                    if i[1].cpc!= None and i[1].cpc.split(':')[0][0] in ['8']]
-    price_data, processes_with_proxy_data = update_price_data(price_data,
-                            services_indices, var_dic['c_services'],
-                            processes_with_proxy_data)
-
-    # Waste and Scraps (cpc starts with 39)
-    dummy_df = PRO.loc[hybrid_processes_without_baci_price,'cpc'
-                                ].str.split(':').str.get(0).str.startswith('39')
-    waste_and_scrap_indices = dummy_df.loc[dummy_df.values == True].index
-    price_data, processes_with_proxy_data = update_price_data(price_data,
-                            waste_and_scrap_indices,
-                            var_dic['c_waste'],
-                            processes_with_proxy_data)
-
-    # Remaining activities
-    left_over_indices = [index for index in hybrid_processes_without_baci_price
-                         if index not in processes_with_proxy_data]
-    price_data, processes_with_proxy_data = update_price_data(price_data,
-                            left_over_indices, var_dic['c_other'],
-                            processes_with_proxy_data)
-
-    return price_data
-
-
-
-def update_price_data(price_data, indices, s, processes_with_proxy_data):
-
+    processlist = set(processlist)
+    hybrid_processes_without_baci_price = pd.Index(
+            [x for x in hybridized_processes if x not in processlist]).unique()
+    category = price_category(
+            PRO.loc[hybrid_processes_without_baci_price, 'cpc'])
+    s = category.map(var_dic).to_numpy(dtype='float64')
+    return update_price_data(price_data, hybrid_processes_without_baci_price,
+                             s, seed)
+
+
+def price_category(cpc):
+    """Returns the var_dic key of the price category of every cpc code in the
+    Series cpc:
+    'c_elec'            electrical energy (cpc 17100)
+    'c_heat'            steam and hot water, often from 'heat and power
+                        cogeneration' (cpc 17300)
+    'c_construction'    construction work (cpc code that starts with 5)
+    'c_freight'         freight transport (cpc code that starts with 6)
+    'c_finance'         financial related services (cpc code that starts with 7)
+    'c_services'        services (cpc code that starts with 8)
+    'c_waste'           waste and scraps (cpc code that starts with 39)
+    'c_other'           all other codes and missing codes
+    """
+    code = cpc.str.split(':').str.get(0).fillna('')
+    first = code.str[:1]
+    return pd.Series(np.select([code == '17100',
+                                code == '17300',
+                                first == '5',
+                                first == '6',
+                                first == '7',
+                                first == '8',
+                                code.str.startswith('39')],
+                               ['c_elec', 'c_heat', 'c_construction',
+                                'c_freight', 'c_finance', 'c_services',
+                                'c_waste'],
+                               default='c_other'),
+                     index=cpc.index)
+
+
+def update_price_data(price_data, indices, s, seed=1):
+    """Replaces the fixed prices of the processes in indices by lognormal
+    samples with shape s (a number or an array with one value per process)
+    and a mean equal to the fixed price. Every process draws from its own
+    stream, seeded with seed and its position in price_data, so its samples
+    do not depend on which other processes are modelled. Returns the updated
+    price_data data frame."""
+    if len(indices) == 0:
+        return price_data
     n = price_data.shape[1]
-    scale_multiplier = np.exp(-s**2/2)
-    for index in indices:
-        price = price_data.loc[index,0]  # this is a fixed number so just take the first
-        scale = price*scale_multiplier
-        price_data.loc[index] = stats.lognorm(s=s, scale=scale).rvs(size=n, random_state=1)
-        processes_with_proxy_data.append(index)
-    return price_data, processes_with_proxy_data
+    s = np.broadcast_to(np.asarray(s, dtype='float64'), (len(indices),))
+    positions = price_data.index.get_indexer(indices)
+    values = price_data.to_numpy(dtype='float64', copy=True)
+    price = values[positions, 0]  # this is a fixed number so just take the first
+    scale = price*np.exp(-s**2/2)
+    normal = np.stack([np.random.default_rng(np.random.SeedSequence(
+                           seed, spawn_key=(int(position),))).standard_normal(n)
+                       for position in positions])
+    values[positions] = scale[:, None]*np.exp(s[:, None]*normal)
+    return pd.DataFrame(values, index=price_data.index,
+                        columns=price_data.columns)
@@ -6,7 +6,8 @@ import json
 import warnings
 import pickle
 import time
-import pdb
+import hashlib
+from .instrumentation import get_instrumentation
 
 path = '/home/jakobs/Documents/IndEcol/OASES/pylcaio/src/Databases/ecoinvent3.5_exiobase3/baci_price_data_2012_data_cpc21_hs12/'
 
@@ -21,7 +22,15 @@ def Match_BACI_data_to_ecoinvent(
         mapping_data_dir='../mapping_data/',
         region_mapping_dict_name='ecoinvent35-baci_region_mapping.json',
         commodity_mapping_dict_name='ecoinvent35-HS12_mapping.json',
-        n_cores=None
+        n_cores=None,
+        shared_samples=False,
+        batch_size=50,
+        max_in_flight=None,
+        output='pickle',
+        cache_dir=None,
+        seed=None,
+        incremental=True,
+        instrumentation=None
         ):
     """
     This function matches BACI price distribution data to ecoinvent activties
@@ -29,6 +38,17 @@ def Match_BACI_data_to_ecoinvent(
     volume (in tons) weighted price distribution of all trade flows exported from
     the activity's region (geography). For every actitvity with a match it outputs
     a pickle file in the outputDir. It relies on Ray multiprocessing.
+    Activities that resolve to the same set of BACI regions and HS codes have
+    the same price distribution, which is therefore calculated only once per
+    unique set (see get_baci_price_data_for_keys). The BACI prices and the row
+    index are put in the Ray object store once and shared by all workers,
+    which process the keys in batches. Returns a dictionary with the status
+    of every activity, see get_baci_price_data_for_keys, or 'no region' if
+    its region is not in the region mapping.
+    A manifest with a hash of the resolved inputs of every activity is saved
+    in outputDir ('baci_match_manifest.json'). On a later run with the same
+    outputDir only the activities whose hash changed are matched again, and
+    the outputs of activities that no longer match are removed.
     
     Input:
 
@@ -51,13 +71,57 @@ def Match_BACI_data_to_ecoinvent(
                             mapping directory. Default: 'ecoinvent35-HS12_mapping.json',
     n_cores                 Number of cores to use for the multiprocessing.
                             Default: N_max-1, where N_max = # available cpu's
+    shared_samples          If True, activities with the same price
+                            distribution also share the same price sample.
+                            Note that their prices are then fully correlated
+                            in the Monte Carlo. Default: False, i.e. every
+                            activity gets its own sample draw.
+    batch_size              Number of (regions, HS codes) keys per Ray task.
+                            Default: 50
+    max_in_flight           Maximum number of submitted tasks that have not
+                            finished yet. Default: 2*n_cores
+    output                  'pickle' writes one pickle file per activity,
+                            'consolidated' writes all samples as one matrix
+                            and all other information as one summary table
+                            (see write_consolidated_price_data), 'both' does
+                            both. With 'pickle', the consolidated files of an
+                            earlier run in outputDir are removed.
+                            Default: 'pickle'
+    cache_dir               Directory for the binary cache of the BACI csv
+                            file, see readDataBACI. Default: None (no cache)
+    seed                    Root seed of the price samples. Every activity
+                            (or key, with shared_samples) draws from its own
+                            stream derived from the seed and its UUID (or
+                            regions and HS codes), see draw_uniforms, so its
+                            samples are reproducible for the same seed
+                            whatever the batch_size or the other activities
+                            matched. Default: None (not reproducible)
+    incremental             If True and outputDir holds the manifest of an
+                            earlier run, only the activities whose inputs
+                            changed are matched again, see
+                            read_match_manifest. If False, all activities
+                            are matched again. The outputs of activities
+                            that no longer match are removed either way.
+                            Default: True
+    instrumentation         Instrumentation that receives the progress
+                            messages and collects the time and memory of the
+                            stages 'match/read BACI' (with the BACI rows
+                            scanned and kept), 'match/index', 'match/group',
+                            'match/match' (activities/s) and 'match/write',
+                            see instrumentation.Instrumentation.
+                            False silences all messages. Default: None, i.e.
+                            print the messages
    
     """
     
 
+    ins = get_instrumentation(instrumentation)
     # Check if necessary inputs have been given
     if outputDir==None:
         raise Exception("Please provide a path to save the pickle files")
+    if output not in ('pickle', 'consolidated', 'both'):
+        raise Exception("Unknown output '{}'. Please use 'pickle',\
+                'consolidated' or 'both'".format(output))
     if USD_EURO_exr==None:
         warnings.warn("No exchange given. Default rate of 1 will be used")
         USD_EURO_exr = 1 
@@ -80,8 +144,15 @@ def Match_BACI_data_to_ecoinvent(
             mapping_data, region_mapping_dict_name, commodity_mapping_dict_name)
 
 
-    # Load BACI data:
-    baci_data = readDataBACI(path_to_BACI_data, USD_EURO_exr)
+    # Load the BACI data, only the rows with mapped HS codes and exporters:
+    hs_codes = {code for codes in eco_HS12_mapping.values() if codes is not None
+                for code in codes}
+    exporters = {reg for regs in eco_baci_region_mapping_dic.values()
+                 for reg in regs}
+    with ins.stage('match/read BACI'):
+        baci_data = readDataBACI(path_to_BACI_data, USD_EURO_exr,
+                                 cache_dir=cache_dir, hs_codes=hs_codes,
+                                 exporters=exporters, instrumentation=ins)
 
 
 
@@ -89,42 +160,352 @@ def Match_BACI_data_to_ecoinvent(
     outputDir = os.path.realpath(outputDir)
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
-        print('Created the output directory {}'.format(outputDir))
+        ins.log('Created the output directory {}'.format(outputDir))
 
-    # Prepare dictionary for fast row lookup:
-    print('prepare lookup dictionary for faster row lookup...')
-    baci_i_row_dic = {}
-    for reg in baci_data.i.unique():
-        baci_i_row_dic[reg] = np.where(baci_data.i == reg)[0].tolist()
+    # Prepare (HS code, exporter) index for fast row lookup:
+    ins.log('prepare (HS code, exporter) index for faster row lookup...')
+    with ins.stage('match/index'):
+        baci_index = build_baci_index(baci_data)
     
 
     # If not specified, use 1 less than the available number of cores.
     if n_cores==None:
-        n_cores = os.cpu_count()-1
+        n_cores = max(os.cpu_count()-1, 1)
     
-    print("Initializing Ray multiprocessing with {} cores".format(n_cores))
-    ray.init(num_cpus=n_cores)
-     
-    for i,act in enumerate(PRO.loc[(PRO['unitName']=='kg') &
-        (PRO['cpc'].str.split(':').str.get(0).str.len() >= 4)].itertuples()):
-        # only iterate over processes with the right units and with a cpc 
-        # code that has at least 4 digits
-
-        if i%100 ==0:
-            print('{} of total {}'.format(i+1, len(PRO.loc[(PRO['unitName']=='kg') &
-                         (PRO['cpc'].str.split(':').str.get(0).str.len() >=4)])))
-        
-        get_baci_price_data.remote(act.Index, act, eco_baci_region_mapping_dic,
-                                   eco_HS12_mapping, baci_data, baci_i_row_dic,
-                                   Nsamples, outputDir)
+    if max_in_flight==None:
+        max_in_flight = 2*n_cores
     
-    print('Done matching {} activties to BACI price data'.format(i))
-    # Close ray remote
-    print('Shutting down Ray multiprocessing')
-    ray.shutdown()
+    with ins.stage('match/group') as stage:
+        act_groups, region_status = group_activities(
+                PRO, eco_baci_region_mapping_dic, eco_HS12_mapping)
+        i = sum(len(group) for group in act_groups.values())
+        stage.count(i, 'activities')
+        ins.log('{} activities with HS codes share {} unique (regions, HS codes) keys'.format(
+            i, len(act_groups)))
+        if region_status:
+            ins.log('{} activities with HS codes have a region without BACI mapping'.format(
+                len(region_status)))
+
+        # Hash the resolved inputs of every key and compare them with the
+        # manifest of the previous run
+        params = {'USD_EURO_exr': USD_EURO_exr, 'Nsamples': Nsamples,
+                  'seed': seed, 'shared_samples': shared_samples,
+                  'output': output}
+        manifest_file = os.path.join(outputDir, 'baci_match_manifest.json')
+        # Also read without incremental, to remove the outputs of
+        # activities that no longer match
+        old_manifest = read_match_manifest(manifest_file)
+        done_consolidated = consolidated_price_data_index(outputDir)
+        manifest = {}
+        status = dict(region_status)
+        tasks = []
+        for key, group in act_groups.items():
+            key_hash = baci_key_hash(key, baci_data, baci_index, params)
+            todo = [act for act in group
+                    if not (incremental and
+                            up_to_date(old_manifest.get(act.Index), key_hash,
+                                       outputDir, act.Index, output,
+                                       done_consolidated))]
+            if shared_samples and todo:
+                todo = group
+            todo_index = {act.Index for act in todo}
+            for act in group:
+                manifest[act.Index] = {'hash': key_hash}
+                if act.Index not in todo_index:
+                    status[act.Index] = old_manifest[act.Index]['status']
+            if todo:
+                tasks.append((todo, list(key[0]), list(key[1])))
+        n_todo = sum(len(task[0]) for task in tasks)
+        removed = [proc_index for proc_index in
+                   set(old_manifest) | done_consolidated
+                   if proc_index not in manifest]
+        ins.log('{} activities are up to date, matching {} activities, removing {}'.format(
+            i-n_todo, n_todo, len(removed)))
+    batches = [tasks[start:start+batch_size]
+               for start in range(0, len(tasks), batch_size)]
+    root_seed = np.random.SeedSequence(seed).entropy
+
+    shutdown = not ray.is_initialized() and len(batches) > 0
+    if shutdown:
+        ins.log("Initializing Ray multiprocessing with {} cores".format(n_cores))
+        ray.init(num_cpus=n_cores)
+    try:
+        with ins.stage('match/match') as stage:
+            if batches:
+                # Put the large inputs in the object store once, so all
+                # workers share them
+                baci_data = ray.put(baci_data[['p_euro', 'q']])
+                baci_index = ray.put(baci_index)
+            batch_status, records = run_batches(
+                    batches, baci_data, baci_index, root_seed, Nsamples,
+                    outputDir, shared_samples, output, max_in_flight, ins)
+            status.update(batch_status)
+            stage.count(n_todo, 'activities')
+    finally:
+        if shutdown:
+            # Close ray remote
+            ins.log('Shutting down Ray multiprocessing')
+            ray.shutdown()
+
+    with ins.stage('match/write'):
+        # Remove the outputs of activities that no longer match
+        recomputed = [act.Index for task in tasks for act in task[0]]
+        for proc_index in removed + recomputed:
+            if status.get(proc_index) != 'ok':
+                pickle_file = os.path.join(outputDir, '{}.pickle'.format(proc_index))
+                if os.path.isfile(pickle_file):
+                    os.remove(pickle_file)
+        if output != 'pickle':
+            write_consolidated_price_data(outputDir, records,
+                                          replace=removed + recomputed,
+                                          log=ins.log)
+        else:
+            # make_price_df reads the consolidated files if they exist, so
+            # those of an earlier run must not shadow the new pickles
+            remove_consolidated_price_data(outputDir, log=ins.log)
+        for proc_index in manifest:
+            manifest[proc_index]['status'] = status[proc_index]
+        _write_json(manifest_file, manifest)
+    
+    n_ok = sum(1 for s in status.values() if s == 'ok')
+    ins.log('Done matching {} of {} activties to BACI price data'.format(n_ok, i))
+    return status
     
 
-def readDataBACI(path_to_BACI_data, USD_EURO_exr=1):
+def Match_BACI_scenarios_to_ecoinvent(
+        PRO,
+        scenarios,
+        outputDir=None,
+        Nsamples=3000,
+        mapping_data_dir='../mapping_data/',
+        region_mapping_dict_name='ecoinvent35-baci_region_mapping.json',
+        commodity_mapping_dict_name='ecoinvent35-HS12_mapping.json',
+        n_cores=None,
+        shared_samples=False,
+        batch_size=50,
+        max_in_flight=None,
+        cache_dir=None,
+        seed=None,
+        instrumentation=None
+        ):
+    """
+    Same as Match_BACI_data_to_ecoinvent, but for several BACI years and/or
+    exchange rates in one job. The activities are grouped by their (regions,
+    HS codes) key once, every BACI file is read and indexed once and Ray is
+    started once. The prices of every BACI file are sampled once in USD,
+    after which the samples of every exchange rate of that file are derived
+    by rescaling, so scenarios that differ only in the exchange rate share
+    the same draws. The output of every scenario is written in the
+    consolidated format (see write_consolidated_price_data) to
+    outputDir/<scenario name>, which can be passed to
+    make_price_df.make_price_df as price_data_dir. Returns a dictionary with
+    the status dictionary of every scenario.
+
+    Input:
+
+    scenarios               Dictionary {name: (path_to_BACI_data,
+                            USD_EURO_exr)} or list of (path_to_BACI_data,
+                            USD_EURO_exr) tuples, which are then named
+                            '<BACI file name>_<USD_EURO_exr>'
+    PRO, outputDir, Nsamples, mapping_data_dir, region_mapping_dict_name,
+    commodity_mapping_dict_name, n_cores, shared_samples, batch_size,
+    max_in_flight, cache_dir
+                            See Match_BACI_data_to_ecoinvent
+    seed                    Root seed of the price samples, see
+                            Match_BACI_data_to_ecoinvent. All BACI files use
+                            the same streams, so a scenario has the samples
+                            of Match_BACI_data_to_ecoinvent with the same
+                            seed. Default: None (not reproducible)
+    instrumentation         Instrumentation that receives the progress
+                            messages and collects the time and memory of the
+                            stages 'scenarios/group', 'scenarios/read BACI',
+                            'scenarios/index', 'scenarios/match' and
+                            'scenarios/write', see
+                            instrumentation.Instrumentation. False silences
+                            all messages. Default: None, i.e. print the
+                            messages
+
+    """
+    ins = get_instrumentation(instrumentation)
+    if outputDir==None:
+        raise Exception("Please provide a path to save the price data")
+    if isinstance(scenarios, dict):
+        scenarios = dict(scenarios)
+    else:
+        scenarios = {'{}_{}'.format(os.path.splitext(os.path.basename(path))[0],
+                                    exr): (path, exr)
+                     for path, exr in scenarios}
+    for name, (path, exr) in scenarios.items():
+        if exr==None:
+            warnings.warn("No exchange given for scenario {}. Default rate of 1 will be used".format(name))
+            scenarios[name] = (path, 1)
+        if not os.path.isfile(path):
+            raise Exception("Could not find {}. Please provide a valid path to BACI data file".format(path))
+    # The exchange rates of every BACI file
+    files = {}
+    for name, (path, exr) in scenarios.items():
+        files.setdefault(path, []).append((name, exr))
+
+    eco_HS12_mapping, eco_baci_region_mapping_dic = read_mapping_dicts(
+            os.path.realpath(mapping_data_dir), region_mapping_dict_name,
+            commodity_mapping_dict_name)
+    hs_codes = {code for codes in eco_HS12_mapping.values() if codes is not None
+                for code in codes}
+    exporters = {reg for regs in eco_baci_region_mapping_dic.values()
+                 for reg in regs}
+    with ins.stage('scenarios/group') as stage:
+        act_groups, region_status = group_activities(
+                PRO, eco_baci_region_mapping_dic, eco_HS12_mapping)
+        tasks = [(group, list(key[0]), list(key[1]))
+                 for key, group in act_groups.items()]
+        batches = [tasks[start:start+batch_size]
+                   for start in range(0, len(tasks), batch_size)]
+        i = sum(len(group) for group in act_groups.values())
+        stage.count(i, 'activities')
+    ins.log('{} activities with HS codes share {} unique (regions, HS codes) keys, {} scenarios from {} BACI files'.format(
+        i, len(act_groups), len(scenarios), len(files)))
+    if region_status:
+        ins.log('{} activities with HS codes have a region without BACI mapping'.format(
+            len(region_status)))
+
+    if n_cores==None:
+        n_cores = max(os.cpu_count()-1, 1)
+    if max_in_flight==None:
+        max_in_flight = 2*n_cores
+    shutdown = not ray.is_initialized()
+    if shutdown:
+        ins.log("Initializing Ray multiprocessing with {} cores".format(n_cores))
+        ray.init(num_cpus=n_cores)
+
+    root_seed = np.random.SeedSequence(seed).entropy
+    statuses = {}
+    try:
+        for path in files:
+            ins.log('Matching BACI data {}'.format(path))
+            with ins.stage('scenarios/read BACI'):
+                # Prices in USD, the exchange rates are applied by rescaling
+                baci_data = readDataBACI(path, 1, cache_dir=cache_dir,
+                                         hs_codes=hs_codes, exporters=exporters,
+                                         instrumentation=ins)
+            with ins.stage('scenarios/index'):
+                baci_index = ray.put(build_baci_index(baci_data))
+                baci_data = ray.put(baci_data[['p_euro', 'q']])
+            with ins.stage('scenarios/match') as stage:
+                status, records = run_batches(
+                        batches, baci_data, baci_index, root_seed, Nsamples,
+                        None, shared_samples, 'consolidated', max_in_flight,
+                        ins)
+                stage.count(i, 'activities')
+            del baci_data, baci_index
+            with ins.stage('scenarios/write'):
+                for name, exr in files[path]:
+                    scenario_dir = os.path.join(os.path.realpath(outputDir), name)
+                    if not os.path.exists(scenario_dir):
+                        os.makedirs(scenario_dir)
+                    write_consolidated_price_data(
+                            scenario_dir,
+                            [(proc_index, rescale_price_dic(price_dic, 1/exr))
+                             for proc_index, price_dic in records],
+                            log=ins.log)
+                    statuses[name] = dict(region_status, **status)
+            n_ok = sum(1 for s in status.values() if s == 'ok')
+            ins.log('Done matching {} of {} activties to BACI price data for scenarios {}'.format(
+                n_ok, i, [name for name, _ in files[path]]))
+    finally:
+        if shutdown:
+            ins.log('Shutting down Ray multiprocessing')
+            ray.shutdown()
+    return statuses
+
+
+def rescale_price_dic(price_dic, factor):
+    """Returns a copy of price_dic (see make_price_dic) with the sample, the
+    mean, standard deviation, minimum, maximum and percentiles of the price
+    multiplied by factor, e.g. 1/USD_EURO_exr to go from USD to EURO."""
+    price_dic = dict(price_dic)
+    for field in ('price_sample', 'price_baci_mean', 'price_baci_std',
+                  'price_percentiles', 'price_baci_min', 'price_baci_max',
+                  'prices_euro'):
+        if price_dic.get(field) is not None:
+            price_dic[field] = price_dic[field]*factor
+    return price_dic
+
+
+def group_activities(PRO, eco_baci_region_mapping_dic, eco_HS12_mapping):
+    """Returns a dictionary mapping every (regions, HS codes) key (see
+    resolve_baci_key) to the list of activities (rows of PRO.itertuples())
+    with that key, and a status dictionary with 'no region' for the
+    activities whose region is not in the region mapping. Only activities in
+    kg with a cpc code of at least 4 digits and with HS codes are included."""
+    # only iterate over processes with the right units and with a cpc 
+    # code that has at least 4 digits
+    acts = PRO.loc[(PRO['unitName']=='kg') &
+                   (PRO['cpc'].str.split(':').str.get(0).str.len() >= 4)]
+    # Group the activities by their set of BACI regions and HS codes
+    act_groups = {}
+    status = {}
+    for act in acts.itertuples():
+        key = resolve_baci_key(act.Index, act, eco_baci_region_mapping_dic,
+                               eco_HS12_mapping)
+        if key is None:
+            continue
+        if key[0] is None:
+            status[act.Index] = 'no region'
+        else:
+            act_groups.setdefault(key, []).append(act)
+    return act_groups, status
+
+
+def run_batches(batches, baci_data, baci_index, seed, Nsamples=3000,
+                outDir=None, shared_samples=False, output='pickle',
+                max_in_flight=2, instrumentation=None):
+    """Submits get_baci_price_data_batch for every batch of (acts, baci_regs,
+    hs12_codes) tuples, with at most max_in_flight unfinished tasks. All
+    batches get the same root seed (an integer, see draw_uniforms). Ray
+    must be initialized and baci_data and baci_index are best passed as
+    object store references. Returns the merged status dictionary and the
+    records of all batches, in batch order. The activities of a batch whose
+    task fails get the status 'error'."""
+    ins = get_instrumentation(instrumentation)
+    status = {}
+    # records per batch, so they are returned in batch order
+    batch_records = {}
+    pending = {}
+
+    def collect(ref, j):
+        try:
+            status_j, batch_records[j] = ray.get(ref)
+        except ray.exceptions.RayError as error:
+            ins.log('Batch {} failed: {}'.format(j, error))
+            status_j = {act.Index: 'error' for acts, _, _ in batches[j]
+                        for act in acts}
+            batch_records[j] = []
+        status.update(status_j)
+
+    for j, batch in enumerate(batches):
+        if len(pending) >= max_in_flight:
+            done, _ = ray.wait(list(pending), num_returns=1)
+            for ref in done:
+                collect(ref, pending.pop(ref))
+        if j%10 ==0:
+            ins.progress(j+1, len(batches), 'batch')
+        pending[get_baci_price_data_batch.remote(
+                batch, baci_data, baci_index, Nsamples, outDir,
+                shared_samples, output, seed)] = j
+    for ref, j in pending.items():
+        collect(ref, j)
+    records = [record for j in sorted(batch_records)
+               for record in batch_records[j]]
+    invalid = [proc_index for proc_index, s in status.items()
+               if s == 'invalid weights']
+    if invalid:
+        ins.log('Invalid BACI weights for activities {}'.format(invalid))
+    return status, records
+
+
+def readDataBACI(path_to_BACI_data, USD_EURO_exr=1, cache_dir=None,
+                 hs_codes=None, exporters=None, chunksize=1000000,
+                 instrumentation=None):
     """
     Input:
     path_to_BACI_data   path to BACI data file for year to use
@@ -132,17 +513,187 @@ def readDataBACI(path_to_BACI_data, USD_EURO_exr=1):
     USD_EURO_exr        USD per EURO exchange rate default is 1. See EUROSTAT:
                         https://ec.europa.eu/eurostat/databrowser/bookmark/bc107428-d077-4a9a-86a5-a4f045cf63e9?lang=en
 
+    cache_dir           If given, the csv file is converted once to a typed
+                        binary (feather) file in this directory, which is
+                        read instead of the csv file on later calls, see
+                        read_BACI_cache. Default: None
+
+    hs_codes            If given, only the rows with these HS codes (k) are
+                        kept. Flows with a zero or missing quantity or value
+                        are then dropped as well, see filter_BACI_rows.
+                        Without a cache the csv file is read in chunks of
+                        'chunksize' rows, so the full table is never in
+                        memory. Default: None
+
+    exporters           Same as hs_codes, for the exporter codes (i).
+                        Default: None
+
+    instrumentation     Instrumentation for the messages and the counts of
+                        BACI 'rows scanned' and 'rows kept', see
+                        instrumentation.Instrumentation. Default: None, i.e.
+                        print the messages
+
+    """
+    ins = get_instrumentation(instrumentation)
+    filtered = hs_codes is not None or exporters is not None
+    if cache_dir is None and filtered:
+        ins.log('reading in BACI data in chunks of {} rows...'.format(chunksize))
+        chunks = []
+        n_rows = 0
+        for chunk in pd.read_csv(path_to_BACI_data, sep=',',
+                                 dtype={'t':int, 'i':int,
+                                        'j':int, 'k':str,
+                                        'v':float, 'q':float},
+                                 chunksize=chunksize):
+            n_rows += len(chunk)
+            chunks.append(filter_BACI_rows(chunk, hs_codes, exporters))
+        baci_data = pd.concat(chunks, ignore_index=True)
+        ins.log('Kept {} and dropped {} BACI rows'.format(len(baci_data),
+                                                          n_rows-len(baci_data)))
+    elif cache_dir is None:
+        ins.log('reading in BACI data...')
+        baci_data = pd.read_csv(path_to_BACI_data, sep=',',
+                                dtype={'t':int, 'i':int,
+                                       'j':int, 'k':str,
+                                       'v':float, 'q':float})
+        n_rows = len(baci_data)
+    else:
+        baci_data = read_BACI_cache(path_to_BACI_data, cache_dir, log=ins.log)
+        n_rows = len(baci_data)
+        if filtered:
+            baci_data = filter_BACI_rows(baci_data, hs_codes, exporters
+                                         ).reset_index(drop=True)
+            ins.log('Kept {} and dropped {} BACI rows'.format(
+                len(baci_data), n_rows-len(baci_data)))
+    ins.count(n_rows, 'rows scanned')
+    ins.count(len(baci_data), 'rows kept')
+    # v and q may be float32 in the cache, the prices are always float64
+    baci_data['p'] = baci_data['v'].astype('float64')/baci_data['q'].astype('float64')
+    baci_data['p_euro'] = baci_data['p']/USD_EURO_exr
+    return baci_data
+
+
+def filter_BACI_rows(baci_data, hs_codes=None, exporters=None):
+    """Returns the rows of baci_data with an HS code in hs_codes and an
+    exporter in exporters (if given) and a positive quantity and a value."""
+    mask = (baci_data['q'] > 0) & baci_data['v'].notna()
+    if hs_codes is not None:
+        mask &= baci_data['k'].isin(hs_codes)
+    if exporters is not None:
+        mask &= baci_data['i'].isin(exporters)
+    return baci_data.loc[mask]
+
+
+def read_BACI_cache(path_to_BACI_data, cache_dir, log=print):
+    """Returns the BACI table (columns t, i, j, k, v, q) from the binary cache
+    in cache_dir, (re)creating the cache from the csv file if needed.
+    In the cache 'k' is categorical, 't', 'i' and 'j' are narrow integers and
+    'v' and 'q' are float32 if that does not change any of their values.
+    The cache is used if the size and modification time of the csv file
+    match the ones it was made from, or, if only the modification time
+    differs, if the hash of the csv file matches.
     """
-    print('reading in BACI data...')
+    name = os.path.basename(path_to_BACI_data)
+    data_file = os.path.join(cache_dir, name + '.ftr')
+    meta_file = os.path.join(cache_dir, name + '.json')
+    stat = os.stat(path_to_BACI_data)
+    if os.path.isfile(data_file) and os.path.isfile(meta_file):
+        with open(meta_file, 'r') as fh:
+            meta = json.load(fh)
+        valid = meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime
+        if not valid and meta['size'] == stat.st_size:
+            valid = meta['hash'] == file_hash(path_to_BACI_data)
+            if valid:
+                meta['mtime'] = stat.st_mtime
+                _write_json(meta_file, meta)
+        if valid:
+            log('reading in cached BACI data from {}...'.format(data_file))
+            return pd.read_feather(data_file)
+
+    log('reading in BACI data...')
     baci_data = pd.read_csv(path_to_BACI_data, sep=',',
                             dtype={'t':int, 'i':int,
                                    'j':int, 'k':str,
                                    'v':float, 'q':float})
-    baci_data['p'] = baci_data['v']/baci_data['q']
-    baci_data['p_euro'] = baci_data['p']/USD_EURO_exr
+    for col in ['t', 'i', 'j']:
+        baci_data[col] = pd.to_numeric(baci_data[col], downcast='integer')
+    baci_data['k'] = baci_data['k'].astype('category')
+    for col in ['v', 'q']:
+        narrow = baci_data[col].astype('float32')
+        if np.array_equal(narrow.astype('float64').to_numpy(),
+                          baci_data[col].to_numpy(), equal_nan=True):
+            baci_data[col] = narrow
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    baci_data.to_feather(data_file + '.tmp')
+    os.replace(data_file + '.tmp', data_file)
+    _write_json(meta_file, {'size': stat.st_size, 'mtime': stat.st_mtime,
+                            'hash': file_hash(path_to_BACI_data)})
+    log('Saved cached BACI data to {}'.format(data_file))
     return baci_data
 
 
+def file_hash(file_path, chunk_size=2**24):
+    """Returns the blake2b hash of a file."""
+    h = hashlib.blake2b()
+    with open(file_path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_json(file_path, data):
+    with open(file_path + '.tmp', 'w') as fh:
+        json.dump(data, fh)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def build_baci_index(baci_data):
+    """Builds an index of the BACI rows sorted by HS code (k) and exporter (i),
+    so the rows of any set of HS codes and exporters are found with binary
+    searches instead of scans over the full table.
+    Output:
+    Dictionary with
+    'k_codes'       dict mapping the HS codes to integer codes
+    'multiplier'    largest exporter code plus one, so the keys are unique
+    'keys'          sorted keys k_code*multiplier + i of all rows
+    'rows'          row positions in baci_data in the order of 'keys'
+    """
+    k_values, k_uniques = pd.factorize(baci_data['k'])
+    k_codes = {k: code for code, k in enumerate(k_uniques)}
+    exporters = baci_data['i'].to_numpy(dtype='int64')
+    if len(exporters) and exporters.min() < 0:
+        raise Exception("Negative BACI exporter codes can not be indexed")
+    multiplier = int(exporters.max()) + 1 if len(exporters) else 1
+    keys = k_values.astype('int64')*multiplier + exporters
+    rows = np.argsort(keys, kind='stable')
+    return {'k_codes': k_codes, 'multiplier': multiplier, 'keys': keys[rows],
+            'rows': rows}
+
+
+def baci_rows(baci_index, hs_codes, regions):
+    """Returns the sorted row positions of the BACI flows of the given HS
+    codes exported by the given regions (BACI country codes)."""
+    multiplier = baci_index['multiplier']
+    k_codes = [baci_index['k_codes'][k] for k in hs_codes
+               if k in baci_index['k_codes']]
+    regions = np.unique(np.asarray(regions, dtype='int64'))
+    # codes outside [0, multiplier) export nothing and would hit other keys
+    regions = regions[(regions >= 0) & (regions < multiplier)]
+    if not k_codes or len(regions) == 0:
+        return np.array([], dtype='int64')
+    queries = (np.asarray(k_codes, dtype='int64')[:, None]*multiplier +
+               regions[None, :]).ravel()
+    queries = np.unique(queries)
+    starts = np.searchsorted(baci_index['keys'], queries, side='left')
+    stops = np.searchsorted(baci_index['keys'], queries, side='right')
+    rows = [baci_index['rows'][start:stop] for start, stop in zip(starts, stops)
+            if stop > start]
+    if not rows:
+        return np.array([], dtype='int64')
+    return np.sort(np.concatenate(rows))
+
+
 def read_mapping_dicts(mapping_dir, region_mapping_dict_name,
                 commodity_mapping_dict_name):
 
@@ -156,86 +707,329 @@ def read_mapping_dicts(mapping_dir, region_mapping_dict_name,
 
 
 
+def resolve_baci_key(proc_index, act, eco_baci_region_mapping_dic,
+                     eco_HS12_mapping):
+    """Returns the key (sorted tuple of BACI region codes, sorted tuple of
+    HS codes) that determines the BACI price distribution of an activity, or
+    None if the activity has no HS codes. The region codes are None if the
+    geography of the activity (or its UUID for 'RoW') is not in the region
+    mapping."""
+    hs12_codes = eco_HS12_mapping.get(proc_index)
+    if hs12_codes is None:
+        return None
+    if act.geography != 'RoW':
+        baci_regs = eco_baci_region_mapping_dic.get(act.geography)
+    else:
+        baci_regs = eco_baci_region_mapping_dic.get(proc_index)
+    if baci_regs is None:
+        return None, tuple(sorted(set(hs12_codes)))
+    return tuple(sorted(set(baci_regs))), tuple(sorted(set(hs12_codes)))
+
+
 @ray.remote
-def get_baci_price_data(proc_index, act, eco_baci_region_mapping_dic,
-                        eco_HS12_mapping, baci_data, baci_i_row_dic,
-                        draw_nsamples=3000, outDir=None):
-    """Maps baci prices to ecoinvent processes. Uses volume weighted price
-    price distribution from which it draws 'draw_nsamples=3000' samples.
-    Not all ecoinvent activity reference products have 3000 flows which means
-    multiple prices will be sampled more often. This however will not affect the
-    distribution in a significant way.
+def get_baci_price_data_batch(batch, baci_data, baci_index, draw_nsamples=3000,
+                              outDir=None, shared_samples=False, output='pickle',
+                              seed=None):
+    """Ray remote version of get_baci_price_data_for_keys. Nothing is logged
+    on the worker, run_batches reports the activities with invalid weights."""
+    return get_baci_price_data_for_keys(batch, baci_data, baci_index,
+                                        draw_nsamples, outDir, shared_samples,
+                                        output, seed, log=None)
+
+
+def get_baci_price_data_for_keys(batch, baci_data, baci_index,
+                                 draw_nsamples=3000, outDir=None,
+                                 shared_samples=False, output='pickle',
+                                 seed=None, log=print):
+    """Maps BACI prices to groups of ecoinvent activities that share the same
+    BACI regions and HS codes, see resolve_baci_key. The price distribution
+    of a group is the volume (in tons) weighted distribution of the prices of
+    all BACI flows of its HS codes exported from its regions, from which
+    'draw_nsamples' samples are drawn with replacement. The
+    flows of all keys in the batch are concatenated into one array, after
+    which the weighted mean and standard deviation of every key and the
+    samples of all activities are calculated at once, see
+    weighted_segment_stats and sample_segments. A pickle file is then
+    written for every activity. Returns a dictionary with the status of
+    every activity: 'ok' (price data available), 'no flows' (no BACI flows
+    with a positive quantity) or 'invalid weights', and a list of
+    (proc_index, price_dic) records without the raw BACI prices and weights
+    if 'output' is 'consolidated' or 'both'.
     Input:
-    proc_index          the UUID of the ecoinvent activity
-    act                 all meta data from the PRO dataframe for this activity
-    eco_baci_region_mapping_dic
-                        dict mapping ecoinvent regions to BACI region codes
-    eco_HS12_mapping    dict mapping ecoinvent act to HS12 commodities
+    batch               list of (acts, baci_regs, hs12_codes) tuples, with
+                        acts a list of activities (rows of PRO.itertuples()),
+                        baci_regs a list of BACI region codes and hs12_codes
+                        a list of HS12 codes
     baci_data           Dataframe with BACI data
-    baci_i_row_dic      Dictionary mapping rows for each exporting counrty
+    baci_index          (HS code, exporter) row index, see build_baci_index
     draw_nsamples       Numberof samples to draw from the price distribution
     outDir              Directory to save the pickle files
-    
-    
+    shared_samples      If True, all activities of a key get the same sample
+                        draw. Default: False
+    output              'pickle', 'consolidated' or 'both', see
+                        Match_BACI_data_to_ecoinvent
+    seed                Integer root seed of the sample draws. The samples
+                        of every activity (or key, with shared_samples)
+                        come from their own stream, see draw_uniforms.
+                        Default: None (not reproducible)
+    log                 Callable for the messages, or None to not log.
+                        Default: print
     """
-    try:
-        eco_HS12_mapping[proc_index]
-    except KeyError:
-        pdb.set_trace()
-    
-    if eco_HS12_mapping[proc_index] != None:
-        proc, prod = proc_index.split('_')
-        #print(i, ' : ', proc_index) 
-        if act.geography != 'RoW':
-            baci_regs = eco_baci_region_mapping_dic[act.geography]
-            indices_regs = [row for reg in baci_regs if reg in baci_i_row_dic.keys() for row in baci_i_row_dic[reg]]
+    status = {}
+    keys = []
+    key_labels = []
+    for acts, baci_regs, hs12_codes in batch:
+        total_mask = baci_rows(baci_index, hs12_codes, baci_regs)
+        prices_euro = baci_data['p_euro'].iloc[total_mask]
+        weights = baci_data['q'].iloc[total_mask]
+        if len(weights) == 0 or weights.sum() == 0:
+            status.update({act.Index: 'no flows' for act in acts})
+        elif not (np.isfinite(prices_euro).all() and np.isfinite(weights).all()
+                  and (weights >= 0).all()):
+            if log is not None:
+                log('Invalid BACI weights for activities {}'.format(
+                    [act.Index for act in acts]))
+            status.update({act.Index: 'invalid weights' for act in acts})
         else:
-            baci_regs = eco_baci_region_mapping_dic[proc_index]
-            indices_regs = [row for reg in baci_regs if reg in baci_i_row_dic.keys() for row in baci_i_row_dic[reg]]
-           
-        hs12_codes = eco_HS12_mapping[proc_index]
-        indices_prods = [row for prod in hs12_codes for row in np.where(baci_data.k ==prod)[0]]
-        
-        total_mask = list(set(indices_regs).intersection(indices_prods))
-        total_mask.sort()
-        
-        
-        prices_euro = baci_data.loc[total_mask, 'p_euro']
-        weights = baci_data.loc[total_mask, 'q']
+            keys.append((acts, prices_euro, weights))
+            key_labels.append(json.dumps([[int(reg) for reg in baci_regs],
+                                          list(hs12_codes)]))
+    if not keys:
+        return status, []
 
-        try:
-            avg, std = weighted_avg_and_std(prices_euro, weights)
-            sample_price = np.random.choice(prices_euro, size=draw_nsamples,
-                                            p=weights/weights.sum())
-            
-            price_dic = {}
-            price_dic['activityName'] = act.activityName
-            price_dic['geography'] = act.geography
-            price_dic['productName'] = act.productName
-            price_dic['cpc'] = act.cpc
-            price_dic['unitName'] = act.unitName
-            
-            price_dic['prices_euro'] = prices_euro
-            price_dic['weights'] = weights
-            price_dic['price_sample'] = sample_price
-            price_dic['price_baci_mean'] = avg
-            price_dic['price_baci_std'] = std
-            price_dic['price_percentiles'] = np.percentile(sample_price, [2.5,16,50,84,97.5])
-            price_dic['price_baci_min'] = np.min(prices_euro)
-            price_dic['price_baci_max'] = np.max(prices_euro)
-            price_dic['nr_baci_flows'] = len(prices_euro)
-            
-            with open(os.path.join(outDir, '{}.pickle'.format(proc_index)), 'wb') as fh:
-                pickle.dump(price_dic, fh)
-            
-        except ZeroDivisionError:
-            pass
-            
-        except ValueError:
-            print(proc_index)
-            print(price_dic)
-            pdb.set_trace()
+    prices = np.concatenate([prices_euro.to_numpy(dtype='float64')
+                             for _, prices_euro, _ in keys])
+    weights = np.concatenate([weights.to_numpy(dtype='float64')
+                              for _, _, weights in keys])
+    offsets = np.cumsum([0] + [len(prices_euro) for _, prices_euro, _ in keys])
+    avg, std, price_min, price_max = weighted_segment_stats(prices, weights,
+                                                            offsets)
+    # One sample draw per key or per activity
+    if shared_samples:
+        draw_segments = np.arange(len(keys))
+        labels = key_labels
+    else:
+        draw_segments = np.repeat(np.arange(len(keys)),
+                                  [len(acts) for acts, _, _ in keys])
+        labels = [act.Index for acts, _, _ in keys for act in acts]
+    u = draw_uniforms(seed, labels, draw_nsamples)
+    samples = sample_segments(prices, weights, offsets, draw_segments,
+                              draw_nsamples, u=u)
+    percentiles = np.percentile(samples, [2.5,16,50,84,97.5], axis=1).T
 
+    records = []
+    j = 0
+    for segment, (acts, prices_euro, weights) in enumerate(keys):
+        for act in acts:
+            price_dic = make_price_dic(act, prices_euro, weights, samples[j],
+                                       avg[segment], std[segment],
+                                       percentiles[j], price_min[segment],
+                                       price_max[segment])
+            if output != 'consolidated':
+                with open(os.path.join(outDir, '{}.pickle'.format(act.Index)), 'wb') as fh:
+                    pickle.dump(price_dic, fh)
+            if output != 'pickle':
+                del price_dic['prices_euro'], price_dic['weights']
+                records.append((act.Index, price_dic))
+            status[act.Index] = 'ok'
+            if not shared_samples:
+                j += 1
+        if shared_samples:
+            j += 1
+    return status, records
+
+
+def weighted_segment_stats(values, weights, offsets):
+    """Returns the weighted average, weighted standard deviation, minimum and
+    maximum of every segment values[offsets[s]:offsets[s+1]] as arrays. All
+    segments must be non-empty with a positive sum of weights."""
+    starts = offsets[:-1]
+    segment = np.repeat(np.arange(len(starts)), np.diff(offsets))
+    total = np.add.reduceat(weights, starts)
+    average = np.add.reduceat(weights*values, starts)/total
+    variance = np.add.reduceat(weights*(values-average[segment])**2,
+                               starts)/total
+    return (average, np.sqrt(variance), np.minimum.reduceat(values, starts),
+            np.maximum.reduceat(values, starts))
+
+
+def draw_uniforms(seed, labels, draw_nsamples):
+    """Returns a matrix (len(labels), draw_nsamples) of uniform numbers in
+    [0, 1). Row r comes from the stream SeedSequence(seed, spawn_key=(h,)),
+    with h a stable hash of the string labels[r] (an activity UUID or a
+    key), so it only depends on the seed and the label. If seed is None a
+    random root seed is used."""
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    u = np.empty((len(labels), draw_nsamples))
+    for r, label in enumerate(labels):
+        h = int.from_bytes(hashlib.blake2b(label.encode('utf-8'),
+                                           digest_size=8).digest(), 'little')
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(h,)))
+        u[r] = rng.random(draw_nsamples)
+    return u
+
+
+def sample_segments(values, weights, offsets, draw_segments, draw_nsamples,
+                    rng=None, u=None):
+    """Draws draw_nsamples values with replacement from every segment in
+    draw_segments (segment s is values[offsets[s]:offsets[s+1]]) with
+    probabilities proportional to the weights. Same as np.random.choice per
+    segment, but with one call to rng and one searchsorted over all segments:
+    the normalised cumulative weights of segment s are shifted to (s, s+1], so
+    a uniform number u of segment s is found at s+u. Instead of rng, the
+    uniform numbers may be given as u, with shape (len(draw_segments),
+    draw_nsamples), see draw_uniforms.
+    Output:
+    Matrix (len(draw_segments), draw_nsamples) with the sampled values
+    """
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    segment = np.repeat(np.arange(len(starts)), lengths)
+    # Normalise per segment before summing, so a segment with large weights
+    # does not cost the precision of the segments after it
+    total = np.add.reduceat(weights, starts)
+    cdf = np.minimum(np.cumsum(weights/total[segment]) - segment, 1)
+    cdf[offsets[1:]-1] = 1
+    if u is None:
+        u = rng.random((len(draw_segments), draw_nsamples))
+    rows = np.searchsorted(cdf + segment, u + draw_segments[:, None],
+                           side='right')
+    # s+u may round up to s+1 for u close to 1
+    rows = np.minimum(rows, offsets[1:][draw_segments][:, None]-1)
+    return values[rows]
+
+
+def read_match_manifest(manifest_file):
+    """Returns the manifest of an earlier run of Match_BACI_data_to_ecoinvent,
+    a dictionary with per activity the 'hash' of its resolved inputs (see
+    baci_key_hash) and its 'status', or an empty dictionary if there is no
+    manifest."""
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as fh:
+        return json.load(fh)
+
+
+def baci_key_hash(key, baci_data, baci_index, params):
+    """Returns a hash of everything the price data of the activities of a
+    (regions, HS codes) key depend on: the BACI region codes, the HS codes,
+    the prices and quantities of the matching BACI rows and the parameters in
+    the dictionary params (exchange rate, number of samples, seed, ...)."""
+    rows = baci_rows(baci_index, key[1], key[0])
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([list(key[0]), list(key[1]), params],
+                        default=str).encode())
+    h.update(baci_data['p_euro'].to_numpy(dtype='float64')[rows].tobytes())
+    h.update(baci_data['q'].to_numpy(dtype='float64')[rows].tobytes())
+    return h.hexdigest()
+
+
+def up_to_date(entry, key_hash, outDir, proc_index, output, done_consolidated):
+    """Returns True if an activity has the manifest entry of an earlier run
+    with the same hash and its outputs still exist."""
+    if entry is None or entry['hash'] != key_hash or entry['status'] == 'error':
+        return False
+    if entry['status'] != 'ok':
+        return True
+    if output != 'consolidated' and not os.path.isfile(
+            os.path.join(outDir, '{}.pickle'.format(proc_index))):
+        return False
+    return output == 'pickle' or proc_index in done_consolidated
+
+
+def consolidated_price_data_index(outDir):
+    """Returns the set of UUID's in the consolidated output in outDir."""
+    summary_file = os.path.join(outDir, 'baci_price_summary.ftr')
+    if not os.path.isfile(summary_file):
+        return set()
+    return set(pd.read_feather(summary_file, columns=['index'])['index'])
+
+
+def write_consolidated_price_data(outDir, records, replace=None, log=print):
+    """Writes the price data of all activities in two files in outDir:
+    'baci_price_samples.npy'    matrix (N_act, N_samples) with the samples
+    'baci_price_summary.ftr'    feather file with one row per activity, in
+                                the same order, with the activity meta data,
+                                'price_baci_mean', 'price_baci_std',
+                                'price_baci_min', 'price_baci_max',
+                                'nr_baci_flows' and the percentiles as
+                                'price_percentile_2.5' etc. The 'index'
+                                column holds the UUID's.
+    records is a list of (proc_index, price_dic) tuples, see make_price_dic.
+    These files are read by make_price_df.read_BACI_price_data.
+    If replace is a list of UUID's, the existing files are updated instead:
+    the rows of these UUID's are removed and the records are added.
+    The activities are sorted by UUID, so an update gives the same files as
+    writing all records at once.
+    """
+    samples_file = os.path.join(outDir, 'baci_price_samples.npy')
+    summary_file = os.path.join(outDir, 'baci_price_summary.ftr')
+    frames = []
+    if replace is not None and os.path.isfile(summary_file):
+        summary = pd.read_feather(summary_file).set_index('index')
+        keep = ~summary.index.isin(replace)
+        if keep.any():
+            frames.append((np.load(samples_file)[keep], summary.loc[keep]))
+    if records:
+        samples = np.stack([price_dic.pop('price_sample') for _, price_dic in records])
+        summary = pd.DataFrame([price_dic for _, price_dic in records],
+                               index=[proc_index for proc_index, _ in records])
+        percentiles = np.stack(summary.pop('price_percentiles').values)
+        for j, q in enumerate([2.5,16,50,84,97.5]):
+            summary['price_percentile_{}'.format(q)] = percentiles[:, j]
+        summary.index.name = 'index'
+        frames.append((samples, summary))
+    if not frames:
+        warnings.warn("No price data to write")
+        for file_path in (samples_file, summary_file):
+            if replace is not None and os.path.isfile(file_path):
+                os.remove(file_path)
+        return
+    samples = np.concatenate([frame[0] for frame in frames])
+    summary = pd.concat([frame[1] for frame in frames])
+    order = np.argsort(summary.index.to_numpy(dtype=str), kind='stable')
+    samples = samples[order]
+    summary = summary.iloc[order]
+    np.save(samples_file, samples)
+    summary.reset_index().to_feather(summary_file)
+    log('Saved the price data of {} activities to {}'.format(len(summary), outDir))
+
+
+def remove_consolidated_price_data(outDir, log=print):
+    """Removes the consolidated output (see write_consolidated_price_data)
+    from outDir, if there is any."""
+    for name in ('baci_price_samples.npy', 'baci_price_summary.ftr'):
+        file_path = os.path.join(outDir, name)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+            log('Removed the outdated {}'.format(file_path))
+
+
+def make_price_dic(act, prices_euro, weights, sample_price, avg, std,
+                   percentiles=None, price_min=None, price_max=None):
+    """Returns the dictionary with the BACI price information of an activity
+    that is saved in its pickle file. The percentiles of the sample and the
+    minimum and maximum price are calculated if not given."""
+    price_dic = {}
+    price_dic['activityName'] = act.activityName
+    price_dic['geography'] = act.geography
+    price_dic['productName'] = act.productName
+    price_dic['cpc'] = act.cpc
+    price_dic['unitName'] = act.unitName
+    
+    price_dic['prices_euro'] = prices_euro
+    price_dic['weights'] = weights
+    price_dic['price_sample'] = sample_price
+    price_dic['price_baci_mean'] = avg
+    price_dic['price_baci_std'] = std
+    if percentiles is None:
+        percentiles = np.percentile(sample_price, [2.5,16,50,84,97.5])
+    price_dic['price_percentiles'] = percentiles
+    price_dic['price_baci_min'] = np.min(prices_euro) if price_min is None else price_min
+    price_dic['price_baci_max'] = np.max(prices_euro) if price_max is None else price_max
+    price_dic['nr_baci_flows'] = len(prices_euro)
+    return price_dic
 
 
 def weighted_avg_and_std(values, weights):
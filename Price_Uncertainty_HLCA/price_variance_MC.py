@@ -1,37 +1,990 @@
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 import time
 import pandas as pd
+import os
+import json
+import hashlib
+import ray
+from scipy.stats import qmc
+from .instrumentation import get_instrumentation
 
 
 
 
-def do_price_MC(M_io, Lp, Cu, price_data, Nruns = 10):
+def do_price_MC(M_io, Lp, Cu, price_data, Nruns = 10, block_size=100,
+                statistics_only=False, percentiles=(2.5, 16, 50, 84, 97.5),
+                store_dir=None, impact_names=None, process_index=None,
+                process_chunk_size=1000, n_cores=None, A_lca=None,
+                processes=None, sampling=None, seed=None,
+                convergence_rtol=None, check_every=500, stable_fraction=0.95,
+                instrumentation=None, impacts=None):
     """Performs a Monte Carlo based on price variations.
+    The impacts of run i are M_io.dot(Cu * p_i).dot(Lp), where p_i is the i-th
+    column of price_data scaling the columns of Cu. As M_io.dot(Cu) does not
+    change between runs it is calculated once, after which blocks of
+    'block_size' runs are evaluated with a single matrix product (or solve)
+    for all impact categories together, see MC_block. So all rows of M_io
+    (e.g. every category of C_io) cost little more than a single one.
+    Only the columns of Cu with non-zero entries (the hybridized processes)
+    contribute, so only those columns, the matching rows of Lp and price_data
+    are used in the runs. The results cover all processes (columns of Lp).
     Input:
     M_io           The Characteristation multiplier matrix, tehcnically C.dot(S).dot(L_io)
-    Lp             Lenontief inverse of the LCA A-matrix
+    Lp             Lenontief inverse of the LCA A-matrix. Can be None if A_lca
+                   is given. A dense Lp is copied for the rows of the active
+                   processes (see prepare_MC_matrices), which adds
+                   n_active/n_processes of its size to the peak memory. Pass
+                   A_lca or a sparse Lp to avoid that
     Cu             Unscaled Cut off matrix
-    price_data     numpy array containing relevan price sample data or ones for the processes w.o. external prices
+    price_data     numpy array containing relevan price sample data or ones for the processes w.o. external prices.
+                   Can also be the price DataFrame indexed by process UUID,
+                   which is then used as process_index if that is not given
     Nruns          Number of MC runs to perform
+    block_size     Number of runs evaluated at once. Memory use of the
+                   intermediate arrays scales with this number times the
+                   number of impacts. Default: 100
+    statistics_only
+                   If True, the runs are not kept but only used to update
+                   the summary statistics per impact and process, see
+                   MCStatistics. A dictionary with these statistics is
+                   returned instead of the results array. Default: False
+    percentiles    Percentiles to estimate if statistics_only is True, and
+                   to check convergence with (see convergence_rtol). Default: (2.5, 16, 50, 84, 97.5)
+    store_dir      Directory of an on-disk results store, see init_MC_store.
+                   If given, every block of runs is written to the store
+                   instead of being kept in memory and the store metadata is
+                   returned (or the statistics if statistics_only is True).
+                   If the directory already holds a store for the same
+                   problem (including the sampling, seed and price data),
+                   the completed blocks are skipped, which resumes an
+                   interrupted run. Default: None
+    impact_names   Names of the impact categories (rows of M_io), e.g.
+                   Impact_names_io. Saved in the store metadata and returned
+                   with the results (see Output)
+    process_index  Process index (e.g. PRO.index), saved in the store metadata,
+                   returned with the results and used to look up the UUIDs in
+                   'processes'
+    process_chunk_size
+                   Number of processes per chunk file in the store.
+                   Default: 1000
+    n_cores        Number of cores to use. If larger than 1, the blocks of
+                   runs are spread over Ray workers, see MC_blocks. The
+                   results are the same as for a serial run. Default: None,
+                   i.e. a serial run
+    A_lca          Sparse LCA technology matrix in IO convention, i.e.
+                   I - A_ff, or its scipy.sparse.linalg.splu factorization.
+                   Only used if Lp is None, in which case the dense Leontief
+                   inverse is never built but each block of runs is solved
+                   with the factorized transposed system, see LeontiefSolver.
+                   Parallel runs need the matrix, not the factorization.
+    processes      List of process UUIDs (or integer positions) to calculate
+                   the impacts of. Only these columns of Lp are used (or
+                   solved for, if A_lca is given) and the results have the
+                   processes in this order. Default: None, i.e. all processes
+    sampling       How the price vector of each run is obtained, see
+                   PriceSampler. None walks the columns of price_data in
+                   order, 'random', 'lhs' (Latin hypercube) and 'sobol'
+                   (scrambled Sobol) sample each process's empirical price
+                   distribution, in which case Nruns may exceed the number
+                   of columns of price_data. Default: None
+    seed           Seed for the sampling. Default: None
+    convergence_rtol
+                   If given, the runs stop early once the results have
+                   converged. Every 'check_every' runs the percentiles of
+                   every impact and process are calculated from the results
+                   so far (estimated with MCStatistics if statistics_only or
+                   store_dir is given) and a process counts as stable if
+                   none of them changed by
+                   more than this relative tolerance since the previous
+                   check. Then a tuple (output, convergence) is returned,
+                   where convergence is a dictionary with the number of runs
+                   used ('Nruns'), whether the runs converged ('converged')
+                   and the 'trace' of the stable fraction at every check.
+                   Default: None, i.e. all Nruns runs are done
+    check_every    Number of runs between convergence checks. Default: 500
+    stable_fraction
+                   Fraction of stable processes at which the runs stop.
+                   Default: 0.95
+    impacts        List of impact category names (from impact_names) or
+                   row positions of M_io to calculate, in this order.
+                   Default: None, i.e. all rows of M_io
+    instrumentation
+                   Instrumentation that receives the progress messages and
+                   collects the time and memory of the stages
+                   'price_MC/prepare' and 'price_MC/runs' and the
+                   throughput in runs/s, see
+                   instrumentation.Instrumentation. False silences all
+                   messages. Default: None, i.e. print the messages
+
+    Output:
+    MCResults array of shape (n_impacts, n_processes, n_runs) with the
+    impacts of every run, labelled with the impact_names and process_index of
+    the selected impacts and processes. With statistics_only the dictionary
+    of statistics ('impact_names' and 'process_index' included) and with a
+    store_dir the store metadata is returned instead.
     """
-    print("Starting run at {}".format(time.ctime()))
+    ins = get_instrumentation(instrumentation)
+    ins.log("Starting run at {}".format(time.ctime()))
     t0 = time.time()
-    results = np.zeros((M_io.shape[0],Lp.shape[1], Nruns), dtype='float32')
-    print("Results shape: ", results.shape)
+    with ins.stage('price_MC/prepare'):
+        M_io, impact_names = select_impacts(M_io, impacts, impact_names)
+        price_data, process_index, columns = select_processes(
+                price_data, process_index, processes, Cu.shape[1], log=ins.log)
+        MCu, Lp, active = prepare_MC_matrices(M_io, Lp, Cu, A_lca=A_lca,
+                                              columns=columns)
+    ins.log("{} of {} processes have a non-zero cut-off column".format(
+        len(active), Cu.shape[1]))
+    block_size = max(int(block_size), 1)
+    shape = (MCu.shape[0], Lp.shape[1], Nruns)
+    if store_dir is not None:
+        metadata = init_MC_store(store_dir, shape, impact_names=impact_names,
+                                 process_index=process_index,
+                                 run_chunk_size=block_size,
+                                 process_chunk_size=process_chunk_size,
+                                 sampling=sampling, seed=seed,
+                                 price_digest=price_data_digest(price_data,
+                                                                active),
+                                 log=ins.log)
+        block_size = metadata['run_chunk_size']
+        completed = set(metadata['completed_run_chunks'])
+        if completed:
+            ins.log("Resuming, {} of {} blocks already done".format(
+                len(completed), -(-Nruns//block_size)))
+    stats = None
+    if statistics_only or (convergence_rtol is not None and
+                           store_dir is not None):
+        stats = MCStatistics(shape[:2], percentiles)
+    if statistics_only:
+        ins.log("Statistics shape: {}".format(stats.shape))
+    elif store_dir is None:
+        results = np.zeros(shape, dtype='float32')
+        ins.log("Results shape: {}".format(results.shape))
+    ranges = [(start, min(start+block_size, Nruns))
+              for start in range(0, Nruns, block_size)]
+    if store_dir is not None:
+        todo = [r for r in ranges if r[0]//block_size not in completed]
+    else:
+        todo = ranges
+    sampler = PriceSampler(price_data, rows=active, method=sampling,
+                           Nruns=Nruns, seed=seed)
+    blocks = MC_blocks(MCu, Lp, sampler, todo, n_cores=n_cores, log=ins.log)
     x = max(Nruns//50, 1)
-    for i in range(Nruns):
-        if i%x == 0:
-            print("Run {}".format(i+1))
-        # Next line is optional but not necessary, if not used it will just always
-        # regenerate the same distribution but the samples are independent anyways.
-        # price_vector = generate_price_vector(price_data)
-        price_vector = price_data[:,i]
-        Cu_sample = Cu.multiply(price_vector)
-        results[:,:,i] =  M_io.dot(Cu_sample).dot(Lp)
-    print("Finished run at {}".format(time.ctime()))
+    n_done = 0
+    next_check = check_every
+    trace = []
+    converged = False
+    previous = None
+    with ins.stage('price_MC/runs') as runs_stage:
+        for start, stop in ranges:
+            if store_dir is not None and start//block_size in completed:
+                if stats is not None:
+                    stats.update(read_MC_results(store_dir, runs=(start, stop)))
+            else:
+                if -(-start//x) < -(-stop//x):  # a multiple of x lies in this block
+                    ins.progress(start+1, Nruns, 'Run')
+                block = next(blocks)
+                runs_stage.count(stop-start, 'runs')
+                if stats is not None:
+                    stats.update(block)
+                if store_dir is not None:
+                    metadata = write_MC_chunk(store_dir, metadata,
+                                              start//block_size, block)
+                elif not statistics_only:
+                    results[:,:,start:stop] = block
+            n_done = stop
+            if convergence_rtol is not None and n_done >= next_check:
+                if stats is not None:
+                    current = stats.percentile_values()
+                else:
+                    # Exact percentiles, one impact at a time to bound memory
+                    current = np.stack([np.percentile(
+                        results[k, :, :n_done], percentiles, axis=-1)
+                        for k in range(shape[0])], axis=1)
+                fraction = stable_process_fraction(current, previous,
+                                                   convergence_rtol)
+                previous = current
+                trace.append({'Nruns': n_done, 'stable_fraction': fraction})
+                ins.log("{} runs: {:.1%} of the processes are stable".format(
+                    n_done, fraction))
+                if fraction >= stable_fraction:
+                    converged = True
+                    break
+                next_check = (n_done//check_every + 1)*check_every
+        blocks.close()
+    ins.log("Finished run at {}".format(time.ctime()))
     dt = time.time() - t0
-    print("Finished {} runs in {} minutes and {} seconds".format(Nruns, dt//60, dt%60))
-    return results
+    ins.log("Finished {} runs in {} minutes and {} seconds".format(n_done, dt//60, dt%60))
+    if converged:
+        ins.log("Converged after {} of {} runs".format(n_done, Nruns))
+        if store_dir is None and not statistics_only:
+            results = results[:, :, :n_done]
+    if store_dir is not None:
+        # A full run replaces the result of an earlier converged one
+        if converged:
+            metadata['converged_Nruns'] = n_done
+        else:
+            metadata.pop('converged_Nruns', None)
+        _write_MC_metadata(store_dir, metadata)
+    if statistics_only:
+        output = stats.summary()
+        output['process_index'] = (None if process_index is None else
+                                   list(process_index))
+        output['impact_names'] = (None if impact_names is None else
+                                  list(impact_names))
+    elif store_dir is not None:
+        output = metadata
+    else:
+        output = MCResults(results, impact_names, process_index)
+    if convergence_rtol is not None:
+        convergence = {'Nruns': n_done, 'converged': converged, 'trace': trace}
+        return output, convergence
+    return output
+
+
+def price_MC_moments(M_io, Lp, Cu, price_data, A_lca=None, processes=None,
+                     process_index=None, contributions=False, block_size=500,
+                     impacts=None, impact_names=None, instrumentation=None):
+    """Calculates the exact mean and variance of the impacts that the price
+    Monte Carlo samples, without sampling.
+    The impacts M_io.dot(Cu * p).dot(Lp) are linear in the prices p, and the
+    price of every process varies independently (see generate_price_vector).
+    So with mu_j and var_j the mean and variance of the price samples of
+    process j (the rows of price_data), the impacts of process c have
+        mean[k, c] = sum_j MCu[k, j] mu_j Lp[j, c]
+        var[k, c]  = sum_j MCu[k, j]^2 var_j Lp[j, c]^2
+    where MCu = M_io.dot(Cu). The terms of the last sum are the contributions
+    of the price variance of each process j to the variance of process c.
+    Input:
+    M_io, Lp, Cu, price_data, A_lca, processes, process_index, impacts,
+    impact_names   As for do_price_MC
+    contributions  If True, also returns the variance contributions of every
+                   process with a varying price, an array of shape
+                   (n_impacts, n_varying, n_processes). Combine with
+                   'processes' for large databases. Default: False
+    block_size     Number of rows of Lp used at once. Default: 500
+    instrumentation
+                   Instrumentation that receives the progress messages and
+                   collects the time and memory of the stages
+                   'price_MC/prepare' and 'price_MC/moments', see
+                   instrumentation.Instrumentation. False silences all
+                   messages. Default: None, i.e. print the messages
+
+    Output:
+    Dictionary with 'mean', 'var' and 'std' of shape (n_impacts, n_processes),
+    'process_index', 'impact_names' and, if requested, 'contributions' with
+    the index of the
+    contributing processes in 'contribution_process_index'.
+    """
+    ins = get_instrumentation(instrumentation)
+    with ins.stage('price_MC/prepare'):
+        M_io, impact_names = select_impacts(M_io, impacts, impact_names)
+        # The contributors are labelled with the full process index, the
+        # selection replaces process_index
+        full_index = process_index
+        if full_index is None and isinstance(price_data, pd.DataFrame):
+            full_index = price_data.index
+        price_data, process_index, columns = select_processes(
+                price_data, process_index, processes, Cu.shape[1], log=ins.log)
+        MCu, Lp, active = prepare_MC_matrices(M_io, Lp, Cu, A_lca=A_lca,
+                                              columns=columns)
+    prices = np.asarray(price_data[active], dtype='float64')
+    price_mean = prices.mean(axis=1)
+    price_var = prices.var(axis=1)
+    varying = np.flatnonzero(price_var > 0)
+    ins.log("{} of {} active processes have a varying price".format(
+        len(varying), len(active)))
+
+    with ins.stage('price_MC/moments') as stage:
+        # The mean is the impact of the mean prices
+        mean = MC_block(MCu, Lp, price_mean[:, None])[..., 0]
+        var = np.zeros(mean.shape)
+        if contributions:
+            contrib = np.zeros((MCu.shape[0], len(varying), mean.shape[1]))
+        weights = MCu[:, varying]**2*price_var[varying]
+        for start in range(0, len(varying), block_size):
+            stop = min(start+block_size, len(varying))
+            if (start//block_size)%10 == 0:
+                ins.progress(start+1, len(varying), 'Varying process')
+            Lp_rows = Lp_dense_rows(Lp, varying[start:stop])**2
+            var += weights[:, start:stop].dot(Lp_rows)
+            if contributions:
+                contrib[:, start:stop] = weights[:, start:stop, None]*Lp_rows
+        stage.count(len(varying), 'varying processes')
+    moments = {'mean': mean,
+               'var': var,
+               'std': np.sqrt(var),
+               'process_index': (None if process_index is None else
+                                 list(process_index)),
+               'impact_names': (None if impact_names is None else
+                                list(impact_names))}
+    if contributions:
+        moments['contributions'] = contrib
+        contributors = active[varying]
+        if full_index is not None:
+            contributors = [full_index[j] for j in contributors]
+        moments['contribution_process_index'] = list(contributors)
+    return moments
+
+
+def stable_process_fraction(current, previous, rtol):
+    """Returns the fraction of processes whose percentile estimates, with
+    shape (n_percentiles, n_impacts, n_processes), changed by at most the
+    relative tolerance rtol for all percentiles and impacts."""
+    if previous is None:
+        return 0.
+    change = np.abs(current - previous)
+    stable = (change <= rtol*np.abs(current)).all(axis=(0, 1))
+    return float(stable.mean())
+
+
+def select_impacts(M_io, impacts, impact_names):
+    """Resolves the 'impacts' selection of do_price_MC. Returns the selected
+    rows of M_io (always two dimensional) and their names, or their positions
+    if impact_names is None."""
+    if not scipy.sparse.issparse(M_io):
+        M_io = np.atleast_2d(np.asarray(M_io))
+    if impact_names is not None and len(impact_names) != M_io.shape[0]:
+        raise Exception("Got {} impact names for {} rows of M_io".format(
+            len(impact_names), M_io.shape[0]))
+    if impacts is None:
+        return M_io, impact_names
+    rows = _positions(impacts, None if impact_names is None else
+                      [str(name) for name in impact_names], M_io.shape[0])
+    if impact_names is not None:
+        impact_names = [impact_names[k] for k in rows]
+    else:
+        impact_names = rows.tolist()
+    return M_io[rows], impact_names
+
+
+def select_processes(price_data, process_index, processes, n, log=print):
+    """Resolves the 'processes' selection of do_price_MC.
+    Output:
+    price_data     The price data as a numpy array
+    process_index  Index of the processes in the results, i.e. the process
+                   index (or the index of a price DataFrame) or the
+                   positions of the selected processes
+    columns        Positions of the selected processes, or None
+    """
+    if isinstance(price_data, pd.DataFrame):
+        if process_index is None:
+            process_index = price_data.index
+        price_data = price_data.to_numpy()
+    columns = None
+    if processes is not None:
+        columns = _positions(processes, None if process_index is None else
+                             [str(proc) for proc in process_index], n)
+        process_index = (columns.tolist() if process_index is None else
+                         [process_index[c] for c in columns])
+        log("Calculating the impacts of {} selected processes".format(
+            len(columns)))
+    return price_data, process_index, columns
+
+
+def prepare_MC_matrices(M_io, Lp, Cu, A_lca=None, columns=None):
+    """Calculates the run invariant part of the price Monte Carlo, i.e. the
+    product M_io.dot(Cu), as a dense array of shape (n_impacts, n_active).
+    Only the n_active columns of Cu that contain non-zero entries are kept,
+    as the prices of the other processes do not affect the results.
+    If 'columns' is given, only those columns of Lp are kept, in that order.
+    Output:
+    MCu            M_io.dot(Cu) for the active columns
+    Lp             Rows of Lp for the active processes, as a numpy array or
+                   as a sparse matrix if Lp is sparse. If Lp is None, a
+                   LeontiefSolver for A_lca standing in for these rows, or,
+                   if columns are given, the solved columns as numpy array.
+    active         Indices of the active processes (columns of Cu)
+    A dense Lp is copied for the active rows: the products in MC_block need
+    contiguous rows, and scattering the prices into all rows instead would
+    multiply the zero rows of the inactive processes in every block. The
+    copy takes n_active*n_processes values, or only the selected columns if
+    'columns' is given.
+    """
+    Cu = scipy.sparse.csc_matrix(Cu)
+    active = np.flatnonzero(np.diff(Cu.indptr))
+    Cu = Cu[:, active]
+    if scipy.sparse.issparse(M_io):
+        MCu = M_io.dot(Cu).toarray()
+    else:
+        # Let the sparse matrix do the multiplication
+        MCu = np.asarray(Cu.T.dot(np.asarray(M_io).T)).T
+    MCu = np.atleast_2d(np.asarray(MCu, dtype='float64'))
+    if Lp is None:
+        if A_lca is None:
+            raise Exception("Please provide either Lp or A_lca")
+        Lp = LeontiefSolver(A_lca, active)
+        if columns is not None:
+            Lp = Lp.columns(columns)
+    elif scipy.sparse.issparse(Lp):
+        Lp = scipy.sparse.csr_matrix(Lp)[active]
+        if columns is not None:
+            Lp = Lp[:, columns]
+    elif columns is not None:
+        # Only copy the selected block, not all active rows
+        Lp = np.asarray(Lp)[np.ix_(active, columns)]
+    else:
+        Lp = np.asarray(Lp)[active]
+    return MCu, Lp, active
+
+
+def MC_blocks(MCu, Lp, sampler, ranges, n_cores=None, log=print):
+    """Generator that evaluates the blocks of runs given by 'ranges', a list
+    of (start, stop) run ranges, and yields their results in the same order.
+    The price blocks are taken from the PriceSampler 'sampler', whose rows
+    should match the columns of MCu and rows of Lp (see prepare_MC_matrices).
+    If n_cores > 1 the blocks are evaluated by n_cores Ray actors. MCu and Lp
+    (or the A_lca matrix of a LeontiefSolver, which every worker factorizes
+    once) are put in the Ray object store once, so all workers read the same
+    shared memory instead of receiving a copy. At most two blocks per worker are in
+    flight at any time, and blocks are collected in order, so the output is
+    identical to the serial one.
+    """
+    if n_cores is None or n_cores <= 1:
+        for start, stop in ranges:
+            yield MC_block(MCu, Lp, sampler.block(start, stop))
+        return
+
+    shutdown = not ray.is_initialized()
+    if shutdown:
+        log("Initializing Ray multiprocessing with {} cores".format(n_cores))
+        ray.init(num_cpus=n_cores)
+    try:
+        MCu_ref = ray.put(MCu)
+        if isinstance(Lp, LeontiefSolver):
+            if Lp.A_lca is None:
+                raise Exception("Parallel runs need the A_lca matrix instead\
+                        of its factorization")
+            Lp_ref = ['A_lca', ray.put(Lp.A_lca.data), ray.put(Lp.A_lca.indices),
+                      ray.put(Lp.A_lca.indptr), Lp.A_lca.shape, Lp.active]
+        elif scipy.sparse.issparse(Lp):
+            Lp = scipy.sparse.csr_matrix(Lp)
+            Lp_ref = ['csr', ray.put(Lp.data), ray.put(Lp.indices),
+                      ray.put(Lp.indptr), Lp.shape]
+        else:
+            Lp_ref = ray.put(Lp)
+        workers = [MCWorker.remote(MCu_ref, Lp_ref) for _ in range(n_cores)]
+        pending = []
+        for i, (start, stop) in enumerate(ranges):
+            if len(pending) >= 2*n_cores:
+                yield ray.get(pending.pop(0))
+            price_block = sampler.block(start, stop)
+            pending.append(workers[i % n_cores].run.remote(price_block))
+        while pending:
+            yield ray.get(pending.pop(0))
+    finally:
+        if shutdown:
+            log('Shutting down Ray multiprocessing')
+            ray.shutdown()
+
+
+@ray.remote
+class MCWorker:
+    """Ray actor evaluating blocks of MC runs on shared MCu and Lp arrays.
+    A sparse Lp is passed as a list ['csr', data, indices, indptr, shape] of
+    object references, so its arrays are shared as well. The A_lca matrix of
+    a LeontiefSolver is passed as ['A_lca', data, indices, indptr, shape,
+    active] (in csc format) and factorized once by the actor.
+    """
+
+    def __init__(self, MCu, Lp):
+        self.MCu = MCu
+        if isinstance(Lp, list):
+            kind, data, indices, indptr, shape = [
+                    ray.get(x) if isinstance(x, ray.ObjectRef) else x
+                    for x in Lp[:5]]
+            if kind == 'A_lca':
+                Lp = LeontiefSolver(scipy.sparse.csc_matrix(
+                        (data, indices, indptr), shape=shape), Lp[5])
+            else:
+                Lp = scipy.sparse.csr_matrix((data, indices, indptr),
+                                             shape=shape, copy=False)
+        self.Lp = Lp
+
+    def run(self, price_block):
+        return MC_block(self.MCu, self.Lp, price_block)
+
+
+def MC_block(MCu, Lp, price_block):
+    """Evaluates a block of MC runs at once.
+    Input:
+    MCu            Run invariant product M_io.dot(Cu), shape (n_impacts, n)
+    Lp             Leontief inverse of the LCA A-matrix
+    price_block    Price samples, shape (n, n_runs), one column per run
+
+    Output:
+    Impacts of shape (n_impacts, n_processes, n_runs)
+    Row k of M_io.dot(Cu * p).dot(Lp) equals Lp.T.dot(MCu[k] * p), so the
+    price scaled inputs of all impacts and runs are stacked into one matrix
+    of n_impacts*n_runs columns, which takes a single product with Lp (or a
+    single solve) for all impacts.
+    """
+    n_impacts, n = MCu.shape
+    n_runs = price_block.shape[1]
+    x = (MCu[:, :, None]*price_block[None]).transpose(1, 0, 2).reshape(
+            n, n_impacts*n_runs)
+    if isinstance(Lp, LeontiefSolver):
+        y = Lp.Tdot(x)
+    else:
+        y = Lp.T.dot(x)
+    return np.asarray(y).reshape(-1, n_impacts, n_runs).transpose(1, 0, 2)
+
+
+def Lp_dense_rows(Lp, rows):
+    """Returns the given rows of Lp (as returned by prepare_MC_matrices) as a
+    dense numpy array."""
+    if isinstance(Lp, LeontiefSolver):
+        return Lp.rows(rows)
+    if scipy.sparse.issparse(Lp):
+        return Lp[rows].toarray()
+    return Lp[rows]
+
+
+class LeontiefSolver:
+    """Stands in for the rows 'active' of the Leontief inverse
+    Lp = inv(A_lca) of the LCA system without building it. A_lca is
+    factorized once (scipy's SuperLU), after which Lp[active].T.dot(x) is
+    obtained by solving the transposed system for all columns of x at once.
+    Memory use scales with the sparse factors and the number of columns of x.
+    Input:
+    A_lca          Sparse technology matrix I - A_ff, or an existing
+                   scipy.sparse.linalg.splu factorization of it
+    active         Indices of the rows of Lp to stand in for. Default: all
+    """
+
+    def __init__(self, A_lca, active=None):
+        if isinstance(A_lca, scipy.sparse.linalg.SuperLU):
+            self.A_lca = None
+            self.factor = A_lca
+        else:
+            self.A_lca = scipy.sparse.csc_matrix(A_lca)
+            self.factor = scipy.sparse.linalg.splu(self.A_lca)
+        n = self.factor.shape[0]
+        self.active = np.arange(n) if active is None else np.asarray(active)
+        self.shape = (len(self.active), n)
+
+    def Tdot(self, x):
+        """Returns Lp[active].T.dot(x) for x of shape (n_active, k)."""
+        rhs = np.zeros((self.shape[1], x.shape[1]))
+        rhs[self.active] = x
+        return self.factor.solve(rhs, trans='T')
+
+    def rows(self, rows):
+        """Returns Lp[active][rows] as a numpy array, which takes one solve
+        per row."""
+        rows = np.asarray(rows)
+        rhs = np.zeros((self.shape[1], len(rows)))
+        rhs[self.active[rows], np.arange(len(rows))] = 1
+        return self.factor.solve(rhs, trans='T').T
+
+    def columns(self, columns):
+        """Returns Lp[active][:, columns] as a numpy array, which takes one
+        solve per column."""
+        columns = np.asarray(columns)
+        rhs = np.zeros((self.shape[1], len(columns)))
+        rhs[columns, np.arange(len(columns))] = 1
+        return self.factor.solve(rhs)[self.active]
+
+
+def init_MC_store(store_dir, shape, impact_names=None, process_index=None,
+                  run_chunk_size=100, process_chunk_size=1000, sampling=None,
+                  seed=None, price_digest=None, log=print):
+    """Creates an on-disk store for MC results of the given shape
+    (n_impacts, n_processes, Nruns), or opens the existing one in store_dir.
+    The results are saved as .npy chunk files of at most process_chunk_size
+    processes by run_chunk_size runs, next to a 'metadata.json' file with the
+    shape, chunk sizes, impact names, process index, sampling method, seed,
+    price data digest (see price_data_digest) and the run chunks that have
+    been completed. Returns the metadata dictionary.
+    An existing store is reused only if its shape, impact names, process
+    index, sampling method, seed and price data digest match, in which case
+    its chunk sizes are kept.
+    """
+    shape = [int(n) for n in shape]
+    if impact_names is not None:
+        impact_names = [str(name) for name in impact_names]
+    if process_index is not None:
+        process_index = [str(proc) for proc in process_index]
+    # as it reads back from json
+    seed = json.loads(json.dumps(seed, default=str))
+    problem = {'shape': shape,
+               'impact_names': impact_names,
+               'process_index': process_index,
+               'sampling': sampling,
+               'seed': seed,
+               'price_digest': price_digest}
+    metadata_path = os.path.join(store_dir, 'metadata.json')
+    if os.path.isfile(metadata_path):
+        metadata = read_MC_metadata(store_dir)
+        different = [key for key, value in problem.items()
+                     if metadata.get(key) != value]
+        if different:
+            raise Exception("{} contains MC results for a different problem\
+                    (different {}). Please provide a new store directory".format(
+                        store_dir, ', '.join(different)))
+        return metadata
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+        log('Created the output directory {}'.format(store_dir))
+    metadata = {'dtype': 'float32',
+                'run_chunk_size': int(run_chunk_size),
+                'process_chunk_size': int(process_chunk_size),
+                'completed_run_chunks': []}
+    metadata.update(problem)
+    _write_MC_metadata(store_dir, metadata)
+    return metadata
+
+
+def price_data_digest(price_data, rows=None):
+    """Returns a hash of the rows of price_data (all if None) that the runs
+    use, to recognise the price data of a store."""
+    prices = np.ascontiguousarray(price_data if rows is None else
+                                  price_data[rows], dtype='float64')
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps(prices.shape).encode())
+    h.update(prices.tobytes())
+    return h.hexdigest()
+
+
+def write_MC_chunk(store_dir, metadata, run_chunk, block):
+    """Writes the results of run chunk 'run_chunk', with shape
+    (n_impacts, n_processes, n_runs_in_chunk), to the store and marks it as
+    completed. Returns the updated metadata.
+    """
+    pcs = metadata['process_chunk_size']
+    for p in range(-(-metadata['shape'][1]//pcs)):
+        file_path = os.path.join(store_dir, _chunk_name(run_chunk, p))
+        with open(file_path + '.tmp', 'wb') as fh:
+            np.save(fh, block[:, p*pcs:(p+1)*pcs].astype(metadata['dtype']))
+        os.replace(file_path + '.tmp', file_path)
+    metadata['completed_run_chunks'] = sorted(
+            set(metadata['completed_run_chunks']) | {int(run_chunk)})
+    _write_MC_metadata(store_dir, metadata)
+    return metadata
+
+
+def read_MC_metadata(store_dir):
+    """Reads the metadata of an MC results store."""
+    with open(os.path.join(store_dir, 'metadata.json'), 'r') as fh:
+        return json.load(fh)
+
+
+def read_MC_results(store_dir, processes=None, runs=None, impacts=None):
+    """Reads (part of) the MC results from a store without loading the other
+    chunks.
+    Input:
+    store_dir      Directory of the store
+    processes      List of process labels (from the process index in the
+                   metadata) or integer positions. Default: all processes
+    runs           Tuple (start, stop) with the range of runs. Default: all
+                   (up to the number of runs used if the run converged)
+    impacts        List of impact names or integer positions. Default: all
+
+    Output:
+    MCResults array of shape (n_impacts, n_processes, n_runs), labelled
+    with the impact names and process index of the metadata
+    """
+    metadata = read_MC_metadata(store_dir)
+    n_impacts, n_processes, Nruns = metadata['shape']
+    rcs = metadata['run_chunk_size']
+    pcs = metadata['process_chunk_size']
+    impact_pos = _positions(impacts, metadata['impact_names'], n_impacts)
+    process_pos = _positions(processes, metadata['process_index'], n_processes)
+    Nruns = metadata.get('converged_Nruns', Nruns)
+    start, stop = (0, Nruns) if runs is None else runs
+    stop = min(stop, Nruns)
+    missing = [r for r in range(start//rcs, -(-stop//rcs))
+               if r not in metadata['completed_run_chunks']]
+    if missing:
+        raise Exception("Run chunks {} of {} have not been completed".format(
+                missing, store_dir))
+    out = np.empty((len(impact_pos), len(process_pos), max(stop-start, 0)),
+                   dtype=metadata['dtype'])
+    process_chunks = process_pos//pcs
+    for r in range(start//rcs, -(-stop//rcs)):
+        r0, r1 = max(start, r*rcs), min(stop, (r+1)*rcs)
+        for p in np.unique(process_chunks):
+            sel = np.flatnonzero(process_chunks == p)
+            chunk = np.load(os.path.join(store_dir, _chunk_name(r, p)),
+                            mmap_mode='r')
+            out[:, sel, r0-start:r1-start] = chunk[:, :, r0-r*rcs:r1-r*rcs][
+                    impact_pos][:, process_pos[sel]-p*pcs]
+    impact_names = metadata['impact_names']
+    if impact_names is not None:
+        impact_names = [impact_names[k] for k in impact_pos]
+    process_index = metadata['process_index']
+    if process_index is not None:
+        process_index = [process_index[j] for j in process_pos]
+    return MCResults(out, impact_names, process_index)
+
+
+def _chunk_name(run_chunk, process_chunk):
+    return 'runs_{:05d}_processes_{:05d}.npy'.format(run_chunk, process_chunk)
+
+
+def _write_MC_metadata(store_dir, metadata):
+    metadata_path = os.path.join(store_dir, 'metadata.json')
+    with open(metadata_path + '.tmp', 'w') as fh:
+        json.dump(metadata, fh)
+    os.replace(metadata_path + '.tmp', metadata_path)
+
+
+def _positions(labels, index, n):
+    """Converts a list of labels or integer positions to integer positions."""
+    if labels is None:
+        return np.arange(n)
+    labels = list(labels)
+    if index is not None and not all(isinstance(l, (int, np.integer)) for l in labels):
+        lookup = {label: i for i, label in enumerate(index)}
+        return np.array([lookup[str(l)] for l in labels], dtype=int)
+    return np.asarray(labels, dtype=int)
+
+
+class MCResults(np.ndarray):
+    """MC results array of shape (n_impacts, n_processes, n_runs) with the
+    labels of its first two axes: impact_names (list of the impact names, or
+    row positions of M_io) and process_index (list of the process labels, or
+    positions), either may be None. Arrays derived from it, e.g. by slicing
+    or arithmetic, have no labels (None), as they may no longer match.
+    """
+
+    def __new__(cls, results, impact_names=None, process_index=None):
+        obj = np.asarray(results).view(cls)
+        obj.impact_names = None if impact_names is None else list(impact_names)
+        obj.process_index = None if process_index is None else list(process_index)
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.impact_names = None
+        self.process_index = None
+
+
+class MCStatistics:
+    """Summary statistics of MC results that are updated block by block, so
+    memory use does not depend on the number of runs.
+    Mean and variance are merged exactly per block (Chan et al.), minimum and
+    maximum elementwise. The percentiles are approximated with the extended
+    P-square algorithm (Raatikainen, 1987), which keeps 2m+3 markers per
+    impact and process for m percentiles.
+    Input:
+    shape          Shape of a single run, i.e. (n_impacts, n_processes)
+    percentiles    Percentiles to estimate, between 0 and 100
+    """
+
+    def __init__(self, shape, percentiles=(2.5, 16, 50, 84, 97.5)):
+        self.shape = tuple(shape)
+        self.percentiles = np.sort(np.asarray(percentiles, dtype='float64'))
+        self.n = 0
+        self.mean = np.zeros(self.shape)
+        self.M2 = np.zeros(self.shape)
+        self.min = np.full(self.shape, np.inf)
+        self.max = np.full(self.shape, -np.inf)
+        p = self.percentiles/100
+        # Marker probabilities: 0, p1/2, p1, (p1+p2)/2, p2, ..., pm, (1+pm)/2, 1
+        mids = (np.concatenate(([0], p)) + np.concatenate((p, [1])))/2
+        self.marker_p = np.empty(2*len(p)+3)
+        self.marker_p[0] = 0
+        self.marker_p[1::2] = mids
+        self.marker_p[2:-1:2] = p
+        self.marker_p[-1] = 1
+        self.q = None     # marker heights, shape (n_markers,) + shape
+        self.pos = None   # marker positions (1-based)
+        self._buffer = []
+
+    def update(self, block):
+        """Adds a block of runs with shape self.shape + (n_runs,)."""
+        block = np.asarray(block, dtype='float64')
+        nb = block.shape[-1]
+        if nb == 0:
+            return
+        mean_b = block.mean(axis=-1)
+        M2_b = ((block - mean_b[..., None])**2).sum(axis=-1)
+        n = self.n + nb
+        delta = mean_b - self.mean
+        self.mean += delta*nb/n
+        self.M2 += M2_b + delta**2*self.n*nb/n
+        self.n = n
+        np.minimum(self.min, block.min(axis=-1), out=self.min)
+        np.maximum(self.max, block.max(axis=-1), out=self.max)
+        for i in range(nb):
+            self._add_observation(block[..., i])
+
+    def _add_observation(self, x):
+        n_markers = len(self.marker_p)
+        if self.q is None:
+            self._buffer.append(x.copy())
+            if len(self._buffer) == n_markers:
+                self.q = np.sort(np.stack(self._buffer), axis=0)
+                self.pos = np.broadcast_to(np.arange(1., n_markers+1)[
+                    (slice(None),) + (None,)*len(self.shape)], self.q.shape).copy()
+                self._buffer = []
+            return
+        q, pos = self.q, self.pos
+        # Cell k with q[k] <= x < q[k+1], extreme markers move along with x
+        k = (q[1:-1] <= x).sum(axis=0)
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[-1], x, out=q[-1])
+        pos += np.arange(n_markers)[(slice(None),) + (None,)*x.ndim] > k
+        # All cells have seen the same number of observations
+        desired = 1 + (pos[-1].flat[0]-1)*self.marker_p
+        for i in range(1, n_markers-1):
+            d = desired[i] - pos[i]
+            move = (((d >= 1) & (pos[i+1]-pos[i] > 1)) |
+                    ((d <= -1) & (pos[i-1]-pos[i] < -1)))
+            if not move.any():
+                continue
+            ds = np.sign(d)*move
+            # Piecewise parabolic prediction
+            qp = q[i] + ds/(pos[i+1]-pos[i-1])*(
+                    (pos[i]-pos[i-1]+ds)*(q[i+1]-q[i])/(pos[i+1]-pos[i]) +
+                    (pos[i+1]-pos[i]-ds)*(q[i]-q[i-1])/(pos[i]-pos[i-1]))
+            # Linear prediction where the parabolic one is not monotonic
+            q_next = np.where(ds > 0, q[i+1], q[i-1])
+            pos_next = np.where(ds > 0, pos[i+1], pos[i-1])
+            ql = q[i] + ds*(q_next-q[i])/(pos_next-pos[i])
+            qp = np.where((q[i-1] < qp) & (qp < q[i+1]), qp, ql)
+            q[i] = np.where(move, qp, q[i])
+            pos[i] += ds
+
+    def percentile_values(self):
+        """Returns the (approximate) percentiles with shape
+        (len(percentiles),) + self.shape."""
+        if self.q is None:
+            if not self._buffer:
+                return np.full((len(self.percentiles),) + self.shape, np.nan)
+            # Too few runs for the markers, so the percentiles are exact.
+            return np.percentile(np.stack(self._buffer), self.percentiles, axis=0)
+        return self.q[2:-1:2].copy()
+
+    def summary(self):
+        """Returns a dictionary with the number of runs, the mean, variance,
+        standard deviation, minimum, maximum and percentiles. Arrays have
+        the shape of a single run, percentiles have an additional last axis.
+        """
+        var = self.M2/self.n if self.n > 0 else np.full(self.shape, np.nan)
+        return {'Nruns': self.n,
+                'mean': self.mean.copy(),
+                'var': var,
+                'std': np.sqrt(var),
+                'min': self.min.copy(),
+                'max': self.max.copy(),
+                'percentile_levels': self.percentiles.copy(),
+                'percentiles': np.moveaxis(self.percentile_values(), 0, -1)}
+
+
+class PriceSampler:
+    """Provides the price vectors of the MC runs, block by block.
+    Input:
+    price_data     numpy array with the price samples of every process
+    rows           Rows of price_data (processes) to return. Default: all
+    method         None            Run i uses column i of price_data
+                   'random'        Every process's price is drawn at random
+                                   from its empirical distribution (the row
+                                   of price_data)
+                   'lhs'           Latin hypercube: the Nruns draws of every
+                                   process come from the Nruns equally
+                                   probable strata of its distribution, in
+                                   random order. The order is a keyed
+                                   permutation evaluated per block (see
+                                   _strata), so memory does not grow with
+                                   Nruns
+                   'sobol'         Scrambled Sobol sequence with one
+                                   dimension per process with a varying price
+    Nruns          Total number of runs, needed for 'lhs'
+    seed           Seed, the same seed gives the same samples regardless of
+                   the block sizes. Default: None
+    Processes with a constant price always get that price.
+    """
+
+    def __init__(self, price_data, rows=None, method=None, Nruns=None,
+                 seed=None):
+        if method not in (None, 'random', 'lhs', 'sobol'):
+            raise Exception("Unknown sampling method '{}'".format(method))
+        self.price_data = price_data
+        self.rows = np.arange(price_data.shape[0]) if rows is None else rows
+        self.method = method
+        self.Nruns = Nruns
+        self.seed_sequence = np.random.SeedSequence(seed)
+        if method is None:
+            return
+        prices = np.asarray(price_data[self.rows], dtype='float64')
+        self.constant = prices[:, 0].copy()
+        self.varying = np.flatnonzero((prices != prices[:, :1]).any(axis=1))
+        self.sorted_prices = np.sort(prices[self.varying], axis=1)
+        n_varying = len(self.varying)
+        if method == 'lhs':
+            if Nruns is None:
+                raise Exception("Latin hypercube sampling needs Nruns")
+            rng = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+            # Feistel round keys of every process, see _strata
+            self.keys = rng.integers(0, 2**63, (n_varying, 4), dtype='uint64')
+            self.half_bits = max((int(Nruns)-1).bit_length()+1, 2)//2
+        elif method == 'sobol':
+            if n_varying > 21201:
+                raise Exception("Sobol sampling supports up to 21201 processes\
+                        with a varying price, got {}".format(n_varying))
+            self.sobol = qmc.Sobol(max(n_varying, 1), scramble=True,
+                                   seed=np.random.default_rng(self.seed_sequence))
+
+    def block(self, start, stop):
+        """Returns the price vectors of runs start to stop, as an array of
+        shape (n_rows, stop-start)."""
+        if self.method is None:
+            return np.asarray(self.price_data[self.rows, start:stop],
+                              dtype='float64')
+        if self.method == 'sobol':
+            self.sobol.reset()
+            if start > 0:
+                self.sobol.fast_forward(start)
+            u = self.sobol.random(stop-start).T[:len(self.varying)]
+        else:
+            u = np.stack([self._run_uniforms(i) for i in range(start, stop)],
+                         axis=1)
+            if self.method == 'lhs':
+                u = (self._strata(start, stop) + u)/self.Nruns
+        n_samples = self.sorted_prices.shape[1]
+        sample = np.minimum((u*n_samples).astype(int), n_samples-1)
+        block = np.repeat(self.constant[:, None], stop-start, axis=1)
+        block[self.varying] = np.take_along_axis(self.sorted_prices, sample,
+                                                 axis=1)
+        return block
+
+    def _strata(self, start, stop):
+        """Strata of runs start to stop for every varying process, shape
+        (n_varying, stop-start). The strata of a process are a random
+        permutation of range(Nruns): a 4 round Feistel network keyed per
+        process permutes range(4**half_bits), and values of Nruns or more are
+        permuted again until they fall in range (cycle walking)."""
+        runs = np.arange(start, stop, dtype='uint64')
+        strata = np.broadcast_to(runs, (len(self.varying), len(runs))).copy()
+        rows = np.broadcast_to(np.arange(len(self.varying))[:, None],
+                               strata.shape)
+        todo = np.ones(strata.shape, dtype=bool)
+        while todo.any():
+            strata[todo] = self._feistel(strata[todo], self.keys[rows[todo]])
+            todo = strata >= self.Nruns
+        return strata.astype('int64')
+
+    def _feistel(self, x, keys):
+        h = np.uint64(self.half_bits)
+        mask = np.uint64((1 << self.half_bits) - 1)
+        left, right = x >> h, x & mask
+        for k in range(keys.shape[1]):
+            # splitmix64 style mixing of the right half and the round key
+            z = (right + keys[:, k])*np.uint64(0x9E3779B97F4A7C15)
+            z ^= z >> np.uint64(31)
+            z *= np.uint64(0xBF58476D1CE4E5B9)
+            z ^= z >> np.uint64(29)
+            left, right = right, left ^ (z & mask)
+        return (left << h) | right
+
+    def _run_uniforms(self, run):
+        """Uniform numbers of a single run, from a stream that only depends
+        on the seed and the run number."""
+        rng = np.random.default_rng(np.random.SeedSequence(
+                self.seed_sequence.entropy, spawn_key=(1, run)))
+        return rng.random(len(self.varying))
 
 
 def generate_price_vector(price_data_array):
@@ -0,0 +1,223 @@
+import pandas as pd
+import os
+import sys
+import json
+
+
+
+class RegionResolver:
+    """Resolves ecoinvent regions to lists of BACI country codes. Nothing is
+    read at construction: the BACI country codes, the ecoinvent-BACI country
+    mapping and the region concordance (cutoffmatrix.GetConcordance) are
+    loaded on first use. The lookup dictionaries Code_eco->CODE_BACI and
+    CODE->IN_BACI are built once and every resolved (region, excluded
+    countries) pair is cached.
+    Input:
+    country_codes           Path to the BACI country codes csv file
+                            (country_codes_baci.csv) or a DataFrame with the
+                            columns 'CODE' and 'IN_BACI'
+    country_mapping         Path to a csv file or a DataFrame with the
+                            columns 'Code_eco' and 'CODE_BACI', mapping the
+                            ecoinvent country codes to BACI country codes
+    productConcFile, productPickleFile, regionEcoDir, regionExioDir,
+    regionPickleFile, productOutDir
+                            Inputs of cutoffmatrix.GetConcordance for the
+                            ecoinvent-EXIOBASE region concordance
+    module_dirs             List of directories with the concordance code
+                            (regions_concordance, alogging, cutoffmatrix) to
+                            add to the python path. Default: None
+    log_dir                 Directory for the log file. Default: './'
+    RC                      Region concordance to use instead of the one
+                            from cutoffmatrix.GetConcordance. Default: None
+    """
+    def __init__(self, country_codes, country_mapping, productConcFile=None,
+                 productPickleFile=None, regionEcoDir=None, regionExioDir=None,
+                 regionPickleFile=None, productOutDir=None, module_dirs=None,
+                 log_dir='./', RC=None):
+        self._country_codes = country_codes
+        self._country_mapping = country_mapping
+        self.concordance_files = (productConcFile, productPickleFile,
+                                  regionEcoDir, regionExioDir,
+                                  regionPickleFile, productOutDir)
+        self.module_dirs = module_dirs or []
+        self.log_dir = log_dir
+        self._RC = RC
+        self._cm = None
+        self._eco2baci = None
+        self._in_baci = None
+        self._all_baci_codes = None
+        self.cache = {}
+
+    @property
+    def cm(self):
+        """The cutoffmatrix module, imported on first use."""
+        if self._cm is None:
+            for module_dir in self.module_dirs:
+                if module_dir not in sys.path:
+                    sys.path.append(module_dir)
+            import cutoffmatrix
+            self._cm = cutoffmatrix
+        return self._cm
+
+    @property
+    def RC(self):
+        """The ecoinvent-EXIOBASE region concordance."""
+        if self._RC is None:
+            import alogging
+            logger = alogging.Logger(self.log_dir, 'BACI_price_uncertainty',
+                                     __file__)
+            _, self._RC = self.cm.GetConcordance(*self.concordance_files,
+                                                 logger)
+        return self._RC
+
+    @property
+    def eco2baci(self):
+        """Dictionary Code_eco -> list of CODE_BACI (may contain NaN's)."""
+        if self._eco2baci is None:
+            country_mapping = _read_table(self._country_mapping)
+            self._eco2baci = {}
+            for code_eco, code_baci in zip(country_mapping['Code_eco'],
+                                           country_mapping['CODE_BACI']):
+                self._eco2baci.setdefault(code_eco, []).append(code_baci)
+            self._all_baci_codes = pd.unique(
+                    country_mapping['CODE_BACI']).tolist()
+        return self._eco2baci
+
+    @property
+    def all_baci_codes(self):
+        """List of the unique CODE_BACI of the country mapping."""
+        if self._all_baci_codes is None:
+            self.eco2baci
+        return self._all_baci_codes
+
+    @property
+    def in_baci(self):
+        """Dictionary CODE -> IN_BACI of the BACI country codes."""
+        if self._in_baci is None:
+            country_codes = _read_table(self._country_codes)
+            self._in_baci = dict(zip(country_codes['CODE'],
+                                     country_codes['IN_BACI']))
+        return self._in_baci
+
+    def eco2BACI_region(self, eco_reg, excluded=None):
+        """This function takes an ecoinvent region and gives back the BACI
+        country codes as a list of ints
+        Input:
+        - eco_reg         :  ecoinvent region, string
+        - excluded        :  countries excluded from a 'RoW' region
+
+        Output
+        - baci_codes      :  list of baci country code(s) as ints
+
+        """
+        if eco_reg != eco_reg: # filter for NaN's
+            raise NameError('Invalid ecoinvent region "NaN"')
+        key = (eco_reg, frozenset(excluded) if excluded else None)
+        if key not in self.cache:
+            self.cache[key] = self._resolve(eco_reg, excluded)
+        return list(self.cache[key])
+
+    def _resolve(self, eco_reg, excluded):
+        if eco_reg in self.RC.regionExceptions.keys():  # check if the region is in one of the exceptions
+            eco_reg = self.RC.regionExceptions[eco_reg] # These are some electiricty grids in the US etc
+
+        baci_reg_codes = self.eco2baci.get(eco_reg, [float('nan')])
+        # some countries have multiple mappings (i.e. Namibia as it is not in BACI but is listed in the BACI list,
+        # and is also mapped to Africa NES)
+        if not (len(baci_reg_codes) == 1 and baci_reg_codes[0] != baci_reg_codes[0]):
+            return self.FilterBaciCountries(baci_reg_codes)
+
+        elif eco_reg != 'RoW' and eco_reg != 'GLO':
+            try:
+                countries = self.RC.CountryList(eco_reg)
+            except KeyError:
+                raise KeyError("Can't find region {} in constructive geometries package".format(eco_reg))
+            try:
+                return self.FilterBaciCountries(self._countries2baci(countries))
+            except KeyError:
+                raise KeyError('Region "{}" does not contain valid countries or regions. Returned None'.format(eco_reg))
+
+        elif eco_reg == 'RoW' and excluded:
+            countries = self.RC.RoW(excluded=excluded)
+            return self.FilterBaciCountries(self._countries2baci(countries))
+
+        # 'GLO', or 'RoW' without excluded countries which is then assumed global
+        return self.FilterBaciCountries(self.all_baci_codes)
+
+    def _countries2baci(self, countries):
+        """Returns the unique BACI codes of a list of ecoinvent country codes,
+        raises a KeyError if any of them is not in the country mapping."""
+        missing = [country for country in countries if country not in self.eco2baci]
+        if missing:
+            raise KeyError(missing)
+        return pd.unique(pd.Series([code for country in countries
+                                    for code in self.eco2baci[country]])).tolist()
+
+    def FilterBaciCountries(self, codes):
+        """Filters a list of BACI country codes for nans and if they are
+        present in BACI.
+        Input:
+        - codes            :   List of baci country codes
+
+        Output:            :   subset of input list w/o nan's nor countries
+                               not featuring in BACI, as ints
+        """
+        return [int(code) for code in codes if code == code and
+                self.in_baci[code] == 1]
+
+
+def create_eco_baci_geography_mapping(PRO, resolver, outPath=None, outFile=None):
+    """Returns the dictionary that maps the ecoinvent regions (and the
+    process UUID's of the 'RoW' processes) to lists of BACI country codes,
+    as read by Match_BACI_data_to_ecoinvent.
+    Input:
+    PRO             DataFrame with ecoinvent process meta data
+    resolver        RegionResolver
+    outPath         Directory to save the dictionary json file. Default: the
+                    working directory if outFile is given.
+    outFile         Name of the json file. Default:
+                    'ecoinvent35-baci_region_mapping.json' if outPath is given.
+    """
+    eco_baci_region_mapping_dic = {}
+    covered_regions = set()
+    for proc_index, geography in zip(PRO.index.values, PRO['geography'].values):
+        if geography != 'RoW':
+            if geography in covered_regions:
+                continue
+            covered_regions.add(geography)
+        proc, prod = proc_index.split('_')
+        ecoRegion, excluded = resolver.cm.GetEcoRegion(proc, prod, PRO)
+        if ecoRegion == ecoRegion:
+            try:
+                baci_regs = resolver.eco2BACI_region(eco_reg=ecoRegion,
+                                                     excluded=excluded)
+                if ecoRegion != 'RoW':
+                    eco_baci_region_mapping_dic[ecoRegion] = baci_regs
+                else:
+                    eco_baci_region_mapping_dic[proc_index] =baci_regs
+            except ValueError:
+                print('\n region problem')
+                print(PRO.loc[proc_index])
+                continue
+    if not outPath and not outFile:
+        print('No output path nor file given. Dictionary will be returned but not saved...')
+
+        return eco_baci_region_mapping_dic
+    else:
+        if not outPath:
+            outPath = os.getcwd()
+        if not outFile:
+            outFile = 'ecoinvent35-baci_region_mapping.json'
+        filePath = os.path.join(outPath, outFile)
+        with open(filePath, 'w') as fh:
+            json.dump(eco_baci_region_mapping_dic, fh)
+        print('dictionary saved to {}'.format(filePath))
+
+        return eco_baci_region_mapping_dic
+
+
+def _read_table(table):
+    """Returns table if it is a DataFrame, else reads it as a csv file."""
+    if isinstance(table, pd.DataFrame):
+        return table
+    return pd.read_csv(table, sep=',', encoding='iso-8859-1')
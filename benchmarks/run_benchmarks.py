@@ -0,0 +1,174 @@
+"""Times and memory-profiles the main stages of the package on synthetic
+inputs (see synthetic_data.py) at several sizes and saves the results as
+json, so runs on different commits or machines can be compared.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes small medium --output results.json
+
+Every stage is run 'repeat' times for the wall time (the minimum is kept)
+and once more under tracemalloc for the peak memory of the Python and numpy
+allocations.
+"""
+import numpy as np
+import pandas as pd
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The repository root, so the package is imported as Price_Uncertainty_HLCA
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..'))
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from Price_Uncertainty_HLCA import match_BACI_price_data_to_ecoinvent as match
+from Price_Uncertainty_HLCA import ecoinvent_HS_commodity_mapping as commodity_mapping
+from Price_Uncertainty_HLCA import make_price_df
+from Price_Uncertainty_HLCA import price_variance_MC
+from synthetic_data import make_synthetic_inputs
+
+
+SIZES = {'tiny': {'n_processes': 500, 'n_baci_rows': 20000, 'n_io': 100,
+                  'n_impacts': 2, 'n_samples': 50, 'Nruns': 50},
+         'small': {'n_processes': 2000, 'n_baci_rows': 200000, 'n_io': 500,
+                   'n_impacts': 3, 'n_samples': 200, 'Nruns': 200},
+         'medium': {'n_processes': 8000, 'n_baci_rows': 2000000, 'n_io': 2000,
+                    'n_impacts': 5, 'n_samples': 1000, 'Nruns': 1000},
+         # about the size of ecoinvent 3.5, EXIOBASE and one BACI year
+         'large': {'n_processes': 16000, 'n_baci_rows': 8000000, 'n_io': 9800,
+                   'n_impacts': 10, 'n_samples': 3000, 'Nruns': 3000}}
+
+
+def measure(func, repeat=3, memory=True):
+    """Returns the minimum wall time over 'repeat' calls of func, the peak
+    traced memory in MB of one more call (None if memory is False) and the
+    return value of the last call. Printed output is suppressed."""
+    seconds = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = func()
+            seconds.append(time.perf_counter() - t0)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = func()
+            peak = tracemalloc.get_traced_memory()[1]/2**20
+        finally:
+            tracemalloc.stop()
+    return min(seconds), peak, result
+
+
+def benchmark_size(size, params, work_dir, repeat=3, memory=True, seed=0):
+    """Runs all stage benchmarks for one size and returns a list of result
+    dictionaries."""
+    print('Generating the {} inputs...'.format(size))
+    data = make_synthetic_inputs(work_dir, seed=seed,
+                                 **{key: value for key, value in params.items()
+                                    if key != 'Nruns'})
+    PRO = data['PRO']
+    results = []
+
+    def record(stage, func, **counts):
+        seconds, peak, result = measure(func, repeat=repeat, memory=memory)
+        entry = {'size': size, 'stage': stage, 'seconds': seconds,
+                 'peak_memory_mb': peak}
+        entry.update(counts)
+        results.append(entry)
+        print('{:>8} {:<35} {:10.3f} s {:>10} MB'.format(
+            size, stage, seconds, 'n/a' if peak is None else '{:.1f}'.format(peak)))
+        return result
+
+    # BACI data, only the rows of the mapped HS codes and exporters
+    hs_codes = {code for codes in data['eco_HS12_mapping'].values()
+                if codes is not None for code in codes}
+    exporters = {reg for regs in data['region_mapping'].values() for reg in regs}
+    baci_data = record('readDataBACI',
+                       lambda: match.readDataBACI(data['baci_file'], 1.3,
+                                                  hs_codes=hs_codes,
+                                                  exporters=exporters),
+                       rows=params['n_baci_rows'])
+
+    # Price distributions of all activities, as one batch without Ray
+    baci_index = match.build_baci_index(baci_data)
+    act_groups, _ = match.group_activities(PRO, data['region_mapping'],
+                                           data['eco_HS12_mapping'])
+    batch = [(group, list(key[0]), list(key[1]))
+             for key, group in act_groups.items()]
+    record('get_baci_price_data_for_keys',
+           lambda: match.get_baci_price_data_for_keys(
+                   batch, baci_data[['p_euro', 'q']], baci_index,
+                   params['n_samples'], output='consolidated', seed=seed),
+           activities=sum(len(group) for group in act_groups.values()),
+           keys=len(act_groups))
+
+    # cpc-HS12 mapping
+    cpc_codes = PRO['cpc'].str.split(':').str.get(0)
+    record('create_dict_ecoinvent_HS12',
+           lambda: commodity_mapping.create_dict_ecoinvent_HS12(
+                   data['concordance'], PRO.index, cpc_codes),
+           activities=len(PRO), concordance_rows=len(data['concordance']))
+
+    # Price DataFrame
+    hybridized = list(PRO.index[data['hybridized']])
+    price_file = os.path.join(work_dir, 'price_df.ftr')
+    record('make_price_df',
+           lambda: make_price_df.make_price_df(
+                   PRO, data['price_data_dir'], hybridized, 'price_df.ftr',
+                   outputDir=work_dir, seed=seed),
+           activities=len(PRO), hybridized=len(hybridized))
+
+    # Price Monte Carlo, solving with the sparse A matrix
+    price_data = pd.read_feather(price_file).set_index('index')
+    Nruns = min(params['Nruns'], price_data.shape[1])
+    record('do_price_MC',
+           lambda: price_variance_MC.do_price_MC(
+                   data['M_io'], None, data['Cu'], price_data, Nruns=Nruns,
+                   A_lca=data['A_lca']),
+           runs=Nruns, processes=len(PRO), impacts=params['n_impacts'])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', nargs='+', default=['tiny', 'small'],
+                        choices=list(SIZES))
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='json file to write the results to')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc runs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results.extend(benchmark_size(size, SIZES[size], work_dir,
+                                          repeat=args.repeat,
+                                          memory=not args.no_memory,
+                                          seed=args.seed))
+    output = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'pandas': pd.__version__,
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'seed': args.seed,
+              'sizes': {size: SIZES[size] for size in args.sizes},
+              'results': results}
+    with open(args.output, 'w') as fh:
+        json.dump(output, fh, indent=2)
+    print('Saved the results to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Seeded generator of synthetic inputs with the shapes of the real ones
+(ecoinvent PRO table, BACI trade data, mapping dictionaries, cpc21-hs12
+concordance and the hybrid LCA matrices), for the benchmarks in
+run_benchmarks.py. None of the licensed data is needed.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import os
+import json
+
+
+GEOGRAPHIES = ['GLO', 'RoW', 'RER', 'CH', 'DE', 'FR', 'US', 'CN', 'IN', 'BR',
+               'JP', 'CA', 'AU', 'ZA', 'RU']
+
+
+def synthetic_concordance(n_cpc, n_hs, rng):
+    """Returns a cpc21-hs12 concordance DataFrame with the columns
+    'CPC21code' (5 digit goods codes, starting with 0-4) and 'HS12code'
+    (6 digits, without the dots) with on average 2 HS codes per cpc code."""
+    cpc_codes = np.unique(rng.integers(1000, 49999, n_cpc))
+    hs_codes = np.unique(rng.integers(10000, 999999, n_hs))
+    n_rows = 2*len(cpc_codes)
+    return pd.DataFrame(
+            {'CPC21code': ['{:05d}'.format(c) for c in
+                           np.sort(rng.choice(cpc_codes, n_rows))],
+             'HS12code': ['{:06d}'.format(h) for h in
+                          rng.choice(hs_codes, n_rows)]})
+
+
+def synthetic_PRO(n_processes, concordance, rng):
+    """Returns a PRO-like DataFrame indexed by 'activity_product' UUID's with
+    the columns activityName, productName, geography, unitName, cpc, price
+    and priceless_scale_vector. About half of the processes have a goods cpc
+    code from the concordance (some cut to a 1-4 digit prefix), the others
+    have service codes."""
+    uuids = ['{:08x}-0000-0000-0000-{:012x}_{:08x}-0000-0000-0000-{:012x}'.format(
+        j, j, j, 7*j) for j in range(n_processes)]
+    cpc_goods = concordance['CPC21code'].unique()
+    codes = rng.choice(cpc_goods, n_processes).astype(object)
+    prefix = rng.random(n_processes) < 0.2
+    codes[prefix] = [code[:rng.integers(1, 5)] for code in codes[prefix]]
+    services = rng.random(n_processes) < 0.5
+    codes[services] = ['{:05d}'.format(c) for c in
+                       rng.integers(50000, 99999, services.sum())]
+    price = rng.lognormal(0, 1, n_processes)
+    return pd.DataFrame(
+            {'activityName': ['activity {}'.format(j) for j in range(n_processes)],
+             'productName': ['product {}'.format(j) for j in range(n_processes)],
+             'geography': rng.choice(GEOGRAPHIES, n_processes),
+             'unitName': rng.choice(['kg', 'kg', 'MJ', 'kWh', 'unit'], n_processes),
+             'cpc': [code + ':name' for code in codes],
+             'price': price,
+             'priceless_scale_vector': np.where(rng.random(n_processes) < 0.2,
+                                                price*rng.lognormal(0, .1, n_processes),
+                                                0)},
+            index=uuids)
+
+
+def synthetic_BACI(n_rows, hs_codes, countries, rng, year=2012):
+    """Returns a BACI-shaped trade table with the columns t (year), i
+    (exporter), j (importer), k (HS code), v (value, 1000 USD) and q
+    (quantity, tons). About 1% of the flows have no quantity."""
+    baci_data = pd.DataFrame(
+            {'t': year,
+             'i': rng.choice(countries, n_rows),
+             'j': rng.choice(countries, n_rows),
+             'k': rng.choice(hs_codes, n_rows),
+             'v': np.round(rng.lognormal(3, 2, n_rows), 3),
+             'q': np.round(rng.lognormal(1, 2, n_rows), 3)})
+    baci_data.loc[rng.random(n_rows) < 0.01, 'q'] = np.nan
+    return baci_data
+
+
+def synthetic_mappings(PRO, concordance, countries, rng):
+    """Returns the commodity mapping (UUID -> list of HS codes or None) and
+    the region mapping (ecoinvent region, or UUID for 'RoW' processes ->
+    list of BACI country codes) as read by Match_BACI_data_to_ecoinvent."""
+    hs_per_cpc = concordance.groupby('CPC21code')['HS12code'].unique()
+    eco_HS12_mapping = {}
+    for proc_index, cpc in zip(PRO.index, PRO['cpc'].str.split(':').str.get(0)):
+        if cpc in hs_per_cpc.index:
+            eco_HS12_mapping[proc_index] = hs_per_cpc[cpc].tolist()
+        else:
+            eco_HS12_mapping[proc_index] = None
+    countries = [int(c) for c in countries]
+    region_mapping = {'GLO': countries}
+    for geography in GEOGRAPHIES[2:]:
+        n = len(countries)//3 if geography == 'RER' else 1
+        region_mapping[geography] = sorted(
+                int(c) for c in rng.choice(countries, n, replace=False))
+    for proc_index in PRO.index[PRO['geography'] == 'RoW']:
+        region_mapping[proc_index] = sorted(
+                int(c) for c in rng.choice(countries, 2*len(countries)//3,
+                                           replace=False))
+    return eco_HS12_mapping, region_mapping
+
+
+def synthetic_matrices(n_processes, n_io, n_impacts, rng, density=5e-4,
+                       hybridized_fraction=0.5):
+    """Returns the matrices of the price Monte Carlo:
+    A_lca       sparse I - A_ff (n_processes x n_processes), diagonally
+                dominant, so the Leontief inverse exists
+    Cu          sparse unscaled cut-off matrix (n_io x n_processes) with
+                entries for a fraction of the processes (the hybridized ones)
+    M_io        dense multiplier matrix (n_impacts x n_io)
+    hybridized  positions of the processes with a cut-off column
+    """
+    A_ff = scipy.sparse.random(n_processes, n_processes, density=density,
+                               random_state=rng, format='csc')
+    A_ff.setdiag(0)
+    # scale the columns so every column sums to at most 0.5
+    col_sums = np.asarray(A_ff.sum(axis=0)).ravel()
+    A_ff = A_ff.dot(scipy.sparse.diags(0.5/np.maximum(col_sums, 0.5)))
+    A_lca = (scipy.sparse.identity(n_processes, format='csc') - A_ff).tocsc()
+    hybridized = np.flatnonzero(rng.random(n_processes) < hybridized_fraction)
+    n_entries = 20*len(hybridized)
+    Cu = scipy.sparse.csc_matrix(
+            (rng.lognormal(-3, 1, n_entries),
+             (rng.integers(0, n_io, n_entries),
+              rng.choice(hybridized, n_entries))),
+            shape=(n_io, n_processes))
+    M_io = rng.lognormal(0, 1, (n_impacts, n_io))
+    return A_lca, Cu, M_io, hybridized
+
+
+def synthetic_price_samples(PRO, n_samples, rng, fraction=0.3):
+    """Returns the consolidated matcher output for a random fraction of the
+    processes: the sample matrix and the summary DataFrame, see
+    match_BACI_price_data_to_ecoinvent.write_consolidated_price_data."""
+    processes = PRO.index[rng.random(len(PRO)) < fraction]
+    price = PRO.loc[processes, 'price'].to_numpy()
+    samples = price[:, None]*rng.lognormal(0, 0.5, (len(processes), n_samples))
+    summary = PRO.loc[processes, ['activityName', 'geography', 'productName',
+                                  'cpc', 'unitName']].copy()
+    summary['price_baci_mean'] = samples.mean(axis=1)
+    summary['price_baci_std'] = samples.std(axis=1)
+    summary['price_baci_min'] = samples.min(axis=1)
+    summary['price_baci_max'] = samples.max(axis=1)
+    summary['nr_baci_flows'] = n_samples
+    for q, values in zip([2.5,16,50,84,97.5],
+                         np.percentile(samples, [2.5,16,50,84,97.5], axis=1)):
+        summary['price_percentile_{}'.format(q)] = values
+    summary.index.name = 'index'
+    return samples, summary
+
+
+def make_synthetic_inputs(out_dir, n_processes=1000, n_baci_rows=100000,
+                          n_io=200, n_impacts=3, n_samples=100, n_cpc=2000,
+                          n_hs=4000, n_countries=200, seed=0):
+    """Generates a full set of synthetic inputs and writes the files that
+    the package reads from disk to out_dir:
+    'baci.csv'                      the BACI trade table
+    'mapping/'                      the commodity and region mapping json files
+    'price_data/'                   the consolidated matcher output
+    Returns a dictionary with the in-memory inputs (PRO, concordance,
+    eco_HS12_mapping, region_mapping, A_lca, Cu, M_io, hybridized) and the
+    paths ('baci_file', 'mapping_dir', 'price_data_dir').
+    """
+    rng = np.random.default_rng(seed)
+    concordance = synthetic_concordance(n_cpc, n_hs, rng)
+    PRO = synthetic_PRO(n_processes, concordance, rng)
+    countries = np.sort(rng.choice(np.arange(4, 1000), n_countries,
+                                   replace=False))
+    baci_data = synthetic_BACI(n_baci_rows, concordance['HS12code'].unique(),
+                               countries, rng)
+    eco_HS12_mapping, region_mapping = synthetic_mappings(PRO, concordance,
+                                                          countries, rng)
+    A_lca, Cu, M_io, hybridized = synthetic_matrices(n_processes, n_io,
+                                                     n_impacts, rng)
+    samples, summary = synthetic_price_samples(PRO, n_samples, rng)
+
+    mapping_dir = os.path.join(out_dir, 'mapping')
+    price_data_dir = os.path.join(out_dir, 'price_data')
+    for directory in (mapping_dir, price_data_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    baci_file = os.path.join(out_dir, 'baci.csv')
+    baci_data.to_csv(baci_file, index=False)
+    with open(os.path.join(mapping_dir, 'ecoinvent35-HS12_mapping.json'), 'w') as fh:
+        json.dump(eco_HS12_mapping, fh)
+    with open(os.path.join(mapping_dir, 'ecoinvent35-baci_region_mapping.json'), 'w') as fh:
+        json.dump(region_mapping, fh)
+    np.save(os.path.join(price_data_dir, 'baci_price_samples.npy'), samples)
+    summary.reset_index().to_feather(os.path.join(price_data_dir,
+                                                  'baci_price_summary.ftr'))
+    return {'PRO': PRO,
+            'concordance': concordance,
+            'eco_HS12_mapping': eco_HS12_mapping,
+            'region_mapping': region_mapping,
+            'A_lca': A_lca,
+            'Cu': Cu,
+            'M_io': M_io,
+            'hybridized': hybridized,
+            'baci_file': baci_file,
+            'mapping_dir': mapping_dir,
+            'price_data_dir': price_data_dir}
@@ -0,0 +1,11 @@
+import pytest
+import ray
+
+
+@pytest.fixture(scope='session')
+def ray_session():
+    """One local Ray session for all tests that use Ray. The functions under
+    test leave a session they did not start running."""
+    ray.init(num_cpus=2)
+    yield
+    ray.shutdown()
@@ -0,0 +1,59 @@
+import fnmatch
+
+import numpy as np
+import pandas as pd
+
+from Price_Uncertainty_HLCA import ecoinvent_HS_commodity_mapping as mapping
+
+
+def baseline_mapping(cpc21_hs12, UUIDs, cpc_codes):
+    """The fnmatch based lookups of the original create_dict_ecoinvent_HS12."""
+    by_cpc = cpc21_hs12.set_index('CPC21code')
+    mapping_dic = {}
+    for index, code in zip(UUIDs, cpc_codes):
+        if code is not None and int(code[0]) <= 4:
+            if len(code) == 5:
+                if code in by_cpc.index:
+                    mapping_dic[index] = pd.unique(
+                            by_cpc.loc[[code], 'HS12code']).tolist()
+            else:
+                codes = fnmatch.filter(cpc21_hs12['CPC21code'].tolist(),
+                                       code + '*')
+                mapping_dic[index] = pd.unique(
+                        by_cpc.loc[codes, 'HS12code']).tolist()
+        else:
+            mapping_dic[index] = None
+    return mapping_dic
+
+
+def test_prefix_index_matches_baseline():
+    rng = np.random.default_rng(0)
+    cpc = np.array(['{:05d}'.format(x) for x in rng.integers(0, 50000, 500)])
+    hs = np.array(['{:04d}{:02d}'.format(a, b)
+                   for a, b in rng.integers(0, 9999, (500, 2))])
+    hs[::10] = hs[1::10]  # HS codes shared by several cpc codes
+    cpc21_hs12 = pd.DataFrame({'CPC21code': cpc, 'HS12code': hs})
+    codes = []
+    for r in rng.random(500):
+        if r < .5:
+            codes.append(rng.choice(cpc))
+        elif r < .6:
+            codes.append('{:05d}'.format(rng.integers(0, 50000)))
+        elif r < .9:
+            codes.append(rng.choice(cpc)[:rng.integers(1, 5)])
+        else:
+            codes.append('{:05d}'.format(rng.integers(50000, 99999)))
+    codes[:2] = [None, '9']
+    UUIDs = ['u{}'.format(j) for j in range(len(codes))]
+
+    expected = baseline_mapping(cpc21_hs12, UUIDs, codes)
+    result, len_codes = mapping.create_dict_ecoinvent_HS12(
+            cpc21_hs12, UUIDs, codes, log=lambda message: None)
+    assert result == expected
+    assert len_codes[0] == 0 and len_codes[1] == 0
+    assert len_codes[2] == len(codes[2])
+
+    index = mapping.CPCPrefixIndex(cpc21_hs12)
+    for code in ['0', '12', '123', '4567', cpc[0]]:
+        assert index.lookup(code) == baseline_mapping(
+                cpc21_hs12, ['x'], [code]).get('x')
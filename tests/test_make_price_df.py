@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from Price_Uncertainty_HLCA import make_price_df
+
+
+def test_price_category():
+    cpc = pd.Series(['17100:electricity', '17300:heat', '53211:road',
+                     '65111:freight', '71100:finance', '83111:service',
+                     '39110:scrap', '39120:scrap', '01234:crop', None],
+                    index=list('abcdefghij'))
+    np.testing.assert_array_equal(
+            make_price_df.price_category(cpc),
+            ['c_elec', 'c_heat', 'c_construction', 'c_freight', 'c_finance',
+             'c_services', 'c_waste', 'c_waste', 'c_other', 'c_other'])
+    assert make_price_df.price_category(cpc).index.equals(cpc.index)
+
+
+def test_update_price_data_seeding():
+    index = ['p{}'.format(i) for i in range(6)]
+    price_data = pd.DataFrame(np.repeat(np.arange(1., 7.)[:, None], 20000,
+                                        axis=1), index=index)
+    updated = make_price_df.update_price_data(price_data, ['p1', 'p4'],
+                                              [0.27, 1.05], seed=3)
+    # Untouched processes keep their fixed price, modelled ones keep it as
+    # their mean
+    pd.testing.assert_frame_equal(updated.loc[['p0', 'p2', 'p3', 'p5']],
+                                  price_data.loc[['p0', 'p2', 'p3', 'p5']])
+    np.testing.assert_allclose(updated.loc[['p1', 'p4']].mean(axis=1),
+                               [2., 5.], rtol=0.03)
+    np.testing.assert_allclose(np.log(updated.loc[['p1', 'p4']]).std(axis=1),
+                               [0.27, 1.05], rtol=0.03)
+    # A process's samples do not depend on the other modelled processes
+    alone = make_price_df.update_price_data(price_data, ['p4'], 1.05, seed=3)
+    np.testing.assert_array_equal(alone.loc['p4'], updated.loc['p4'])
+    other = make_price_df.update_price_data(price_data, ['p4'], 1.05, seed=4)
+    assert not np.array_equal(other.loc['p4'], updated.loc['p4'])
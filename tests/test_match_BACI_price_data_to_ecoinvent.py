@@ -0,0 +1,384 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Price_Uncertainty_HLCA import match_BACI_price_data_to_ecoinvent as match
+
+
+@pytest.fixture
+def PRO():
+    """Five activities: two in CH and one RoW activity with the same HS
+    codes, one in a region without BACI codes and one in m3."""
+    return pd.DataFrame(
+            {'activityName': ['a', 'b', 'c', 'd', 'e'],
+             'productName': ['p', 'p', 'p', 'q', 'r'],
+             'geography': ['CH', 'CH', 'RoW', 'XX', 'CH'],
+             'unitName': ['kg', 'kg', 'kg', 'kg', 'm3'],
+             'cpc': ['01234:p', '01234:p', '01234:p', '02345:q', '03456:r']},
+            index=['A', 'B', 'C', 'D', 'E'])
+
+
+@pytest.fixture
+def mappings():
+    eco_HS12_mapping = {'A': ['020120', '010110'], 'B': ['010110', '020120'],
+                        'C': ['010110', '020120'], 'D': ['030130'],
+                        'E': ['030130']}
+    region_mapping = {'CH': [4, 8], 'C': [8, 4]}
+    return region_mapping, eco_HS12_mapping
+
+
+@pytest.fixture
+def baci_data():
+    rng = np.random.default_rng(0)
+    baci_data = pd.DataFrame({'k': rng.choice(['010110', '020120', '030130'], 300),
+                              'i': rng.choice([4, 8, 12], 300),
+                              'q': rng.random(300)})
+    baci_data['p_euro'] = rng.lognormal(size=300)
+    return baci_data
+
+
+def test_baci_rows_matches_scan():
+    rng = np.random.default_rng(0)
+    baci_data = pd.DataFrame({'k': rng.choice(['010110', '020120', '030130'], 500),
+                              'i': rng.choice([4, 999, 1000, 1500, 2004], 500)})
+    baci_index = match.build_baci_index(baci_data)
+    for hs_codes in [['010110'], ['020120', '030130'], ['999999', '010110']]:
+        for regions in [[4], [1000], [1500, 4], [2004, 999], [5000, -1]]:
+            expected = np.flatnonzero(baci_data['k'].isin(hs_codes) &
+                                      baci_data['i'].isin(regions))
+            np.testing.assert_array_equal(
+                    match.baci_rows(baci_index, hs_codes, regions), expected)
+
+
+def test_group_activities(PRO, mappings):
+    act_groups, status = match.group_activities(PRO, *mappings)
+    assert status == {'D': 'no region'}
+    assert list(act_groups) == [((4, 8), ('010110', '020120'))]
+    assert [act.Index for act in act_groups[(4, 8), ('010110', '020120')]] \
+        == ['A', 'B', 'C']
+
+
+@pytest.mark.parametrize('shared_samples', [True, False])
+def test_shared_samples(PRO, mappings, baci_data, shared_samples):
+    act_groups, _ = match.group_activities(PRO, *mappings)
+    batch = [(acts, list(key[0]), list(key[1]))
+             for key, acts in act_groups.items()]
+    status, records = match.get_baci_price_data_for_keys(
+            batch, baci_data, match.build_baci_index(baci_data),
+            draw_nsamples=50, shared_samples=shared_samples,
+            output='consolidated', seed=1)
+    assert status == {'A': 'ok', 'B': 'ok', 'C': 'ok'}
+    samples = np.array([price_dic['price_sample'] for _, price_dic in records])
+    # One draw for the key, or one draw per activity
+    assert len(np.unique(samples, axis=0)) == (1 if shared_samples else 3)
+    flows = baci_data['k'].isin(['010110', '020120']) & baci_data['i'].isin([4, 8])
+    assert np.isin(samples, baci_data['p_euro'][flows]).all()
+    assert records[0][1]['price_baci_mean'] == pytest.approx(
+            np.average(baci_data['p_euro'][flows],
+                       weights=baci_data['q'][flows]))
+
+
+def write_baci_csv(file_name, q):
+    pd.DataFrame({'t': 2012, 'i': [4, 8, 4], 'j': [8, 4, 12],
+                  'k': ['010110', '010110', '020120'], 'v': [1.5, 2., 0.1],
+                  'q': q}).to_csv(file_name, index=False)
+
+
+def test_BACI_cache_invalidation(tmp_path):
+    baci_file = str(tmp_path/'baci.csv')
+    cache_dir = str(tmp_path/'cache')
+    messages = []
+
+    def read():
+        del messages[:]
+        return match.read_BACI_cache(baci_file, cache_dir, log=messages.append)
+
+    def used_cache():
+        return messages[0].startswith('reading in cached')
+
+    write_baci_csv(baci_file, [1., 2., 3.])
+    first = read()
+    assert not used_cache()
+    assert first['k'].dtype == 'category' and first['q'].dtype == 'float32'
+    pd.testing.assert_frame_equal(read(), first)
+    assert used_cache()
+
+    # Touched, same content: the hash confirms the cache
+    stat = os.stat(baci_file)
+    os.utime(baci_file, (stat.st_atime, stat.st_mtime + 10))
+    read()
+    assert used_cache()
+    # Other size
+    write_baci_csv(baci_file, [1., 2., 30.])
+    assert read()['q'].tolist() == [1., 2., 30.]
+    assert not used_cache()
+    # Same size, other content and modification time
+    write_baci_csv(baci_file, [1., 2., 40.])
+    stat = os.stat(baci_file)
+    os.utime(baci_file, (stat.st_atime, stat.st_mtime + 20))
+    assert read()['q'].tolist() == [1., 2., 40.]
+    assert not used_cache()
+
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_filtered_read_matches_unfiltered(tmp_path, cache):
+    rng = np.random.default_rng(1)
+    n = 1000
+    q = rng.random(n)
+    q[rng.random(n) < 0.1] = 0
+    q[rng.random(n) < 0.1] = np.nan
+    v = rng.lognormal(size=n)
+    v[rng.random(n) < 0.1] = np.nan
+    baci_file = str(tmp_path/'baci.csv')
+    pd.DataFrame({'t': 2012, 'i': rng.choice([4, 8, 12], n),
+                  'j': rng.choice([4, 8, 12], n),
+                  'k': rng.choice(['010110', '020120', '030130'], n),
+                  'v': v, 'q': q}).to_csv(baci_file, index=False)
+    cache_dir = str(tmp_path/'cache') if cache else None
+    hs_codes, exporters = ['010110', '030130'], [4, 12]
+    full = match.readDataBACI(baci_file, USD_EURO_exr=1.3,
+                              instrumentation=False)
+    expected = match.filter_BACI_rows(full, hs_codes, exporters
+                                      ).reset_index(drop=True)
+    filtered = match.readDataBACI(baci_file, USD_EURO_exr=1.3,
+                                  cache_dir=cache_dir, hs_codes=hs_codes,
+                                  exporters=exporters, chunksize=77,
+                                  instrumentation=False)
+    assert 0 < len(filtered) < n
+    pd.testing.assert_frame_equal(filtered, expected, check_dtype=not cache,
+                                  check_categorical=False)
+
+
+def test_sample_segments_distribution():
+    values = np.arange(7.)
+    # A segment with huge tonnages before one with small weights, and a
+    # flow without quantity that must never be drawn
+    weights = np.array([1.2345678e17, 3.3e16, 10., 40., 50., 0., 2.])
+    offsets = np.array([0, 2, 5, 7])
+    n = 200000
+    samples = match.sample_segments(values, weights, offsets, np.arange(3),
+                                    n, np.random.default_rng(0))
+    assert samples.shape == (3, n)
+    rng = np.random.default_rng(1)
+    for s in range(3):
+        segment = values[offsets[s]:offsets[s+1]]
+        p = weights[offsets[s]:offsets[s+1]]/weights[offsets[s]:offsets[s+1]].sum()
+        assert np.isin(samples[s], segment[p > 0]).all()
+        freq = np.array([(samples[s] == x).mean() for x in segment])
+        reference = rng.choice(segment, size=n, p=p)
+        freq_choice = np.array([(reference == x).mean() for x in segment])
+        np.testing.assert_allclose(freq, p, atol=0.005)
+        np.testing.assert_allclose(freq, freq_choice, atol=0.01)
+
+
+def test_sample_segments_reproducible():
+    values = np.random.default_rng(0).lognormal(size=20)
+    weights = np.ones(20)
+    offsets = np.array([0, 5, 20])
+    draw = np.array([0, 1, 1])
+    a = match.sample_segments(values, weights, offsets, draw, 10,
+                              np.random.default_rng(5))
+    b = match.sample_segments(values, weights, offsets, draw, 10,
+                              np.random.default_rng(5))
+    np.testing.assert_array_equal(a, b)
+    assert np.isin(a[0], values[:5]).all() and np.isin(a[1:], values[5:]).all()
+
+
+def test_weighted_segment_stats():
+    rng = np.random.default_rng(3)
+    values = rng.lognormal(size=30)
+    weights = rng.random(30)
+    offsets = np.array([0, 4, 17, 30])
+    avg, std, price_min, price_max = match.weighted_segment_stats(
+            values, weights, offsets)
+    for s in range(3):
+        v = values[offsets[s]:offsets[s+1]]
+        w = weights[offsets[s]:offsets[s+1]]
+        expected = match.weighted_avg_and_std(v, w)
+        assert np.isclose(avg[s], expected[0])
+        assert np.isclose(std[s], expected[1])
+        assert price_min[s] == v.min() and price_max[s] == v.max()
+
+
+@pytest.mark.parametrize('shared_samples', [True, False])
+def test_samples_independent_of_batch(PRO, mappings, baci_data, shared_samples):
+    """An activity's samples only depend on the seed and its UUID (or key),
+    not on the other activities or keys in its batch."""
+    PRO.loc['D', 'geography'] = 'CH'
+    act_groups, _ = match.group_activities(PRO, *mappings)
+    batch = [(acts, list(key[0]), list(key[1]))
+             for key, acts in act_groups.items()]
+    baci_index = match.build_baci_index(baci_data)
+
+    def samples(batch):
+        _, records = match.get_baci_price_data_for_keys(
+                batch, baci_data, baci_index, draw_nsamples=50,
+                shared_samples=shared_samples, output='consolidated', seed=7)
+        return {proc_index: price_dic['price_sample']
+                for proc_index, price_dic in records}
+
+    together = samples(batch)
+    assert sorted(together) == ['A', 'B', 'C', 'D']
+    alone = samples([([batch[0][0][2]], batch[0][1], batch[0][2])])
+    np.testing.assert_array_equal(alone['C'], together['C'])
+    reversed_batch = samples(batch[::-1])
+    for proc_index in together:
+        np.testing.assert_array_equal(reversed_batch[proc_index],
+                                      together[proc_index])
+
+
+@pytest.mark.parametrize('incremental', [True, False])
+def test_manifest_removes_outputs(tmp_path, incremental):
+    """An activity of an earlier run that no longer has HS codes loses its
+    pickle and its row in the consolidated output."""
+    baci_file = str(tmp_path/'baci.csv')
+    pd.DataFrame({'t': [2012], 'i': [4], 'j': [8], 'k': ['010110'],
+                  'v': [10.], 'q': [2.]}).to_csv(baci_file, index=False)
+    mapping_dir = tmp_path/'mapping'
+    mapping_dir.mkdir()
+    with open(str(mapping_dir/'ecoinvent35-HS12_mapping.json'), 'w') as fh:
+        json.dump({'X': None}, fh)
+    with open(str(mapping_dir/'ecoinvent35-baci_region_mapping.json'), 'w') as fh:
+        json.dump({'CH': [4]}, fh)
+    PRO = pd.DataFrame({'activityName': ['a'], 'productName': ['p'],
+                        'geography': ['CH'], 'unitName': ['kg'],
+                        'cpc': ['01234:product']}, index=['X'])
+
+    # Outputs of an earlier run that matched X
+    out_dir = tmp_path/'out'
+    out_dir.mkdir()
+    with open(str(out_dir/'baci_match_manifest.json'), 'w') as fh:
+        json.dump({'X': {'hash': 'old', 'status': 'ok'}}, fh)
+    (out_dir/'X.pickle').write_bytes(b'')
+    np.save(str(out_dir/'baci_price_samples.npy'), np.ones((1, 3)))
+    pd.DataFrame({'index': ['X'], 'price_baci_mean': [1.]}).to_feather(
+            str(out_dir/'baci_price_summary.ftr'))
+
+    with pytest.warns(UserWarning, match='No price data'):
+        status = match.Match_BACI_data_to_ecoinvent(
+                PRO, baci_file, outputDir=str(out_dir), USD_EURO_exr=1,
+                Nsamples=10, mapping_data_dir=str(mapping_dir), n_cores=1,
+                output='both', incremental=incremental, instrumentation=False)
+    assert status == {}
+    assert not (out_dir/'X.pickle').exists()
+    assert not (out_dir/'baci_price_samples.npy').exists()
+    assert not (out_dir/'baci_price_summary.ftr').exists()
+    with open(str(out_dir/'baci_match_manifest.json')) as fh:
+        assert json.load(fh) == {}
+
+
+def test_write_consolidated_price_data_replace(tmp_path):
+    def record(proc_index, price):
+        return (proc_index, {'activityName': proc_index,
+                             'price_sample': np.full(4, price),
+                             'price_baci_mean': price,
+                             'price_percentiles': np.full(5, price)})
+    out_dir = str(tmp_path)
+    match.write_consolidated_price_data(out_dir, [record('a', 1.), record('b', 2.)],
+                                        log=lambda message: None)
+    match.write_consolidated_price_data(out_dir, [record('c', 3.)],
+                                        replace=['a'], log=lambda message: None)
+    summary = pd.read_feather(os.path.join(out_dir, 'baci_price_summary.ftr'))
+    samples = np.load(os.path.join(out_dir, 'baci_price_samples.npy'))
+    assert summary['index'].tolist() == ['b', 'c']
+    np.testing.assert_array_equal(samples[:, 0], [2., 3.])
+    assert match.consolidated_price_data_index(out_dir) == {'b', 'c'}
+
+
+def test_incremental_run_matches_fresh_run(tmp_path, PRO, mappings, ray_session):
+    """Rematching only the changed activities, in other batches, gives the
+    same files as matching all activities at once."""
+    region_mapping, eco_HS12_mapping = mappings
+    rng = np.random.default_rng(2)
+    baci_file = str(tmp_path/'baci.csv')
+    pd.DataFrame({'t': 2012, 'i': rng.choice([4, 8, 12], 300),
+                  'j': rng.choice([4, 8, 12], 300),
+                  'k': rng.choice(['010110', '020120', '030130'], 300),
+                  'v': rng.lognormal(size=300), 'q': rng.random(300)}
+                 ).to_csv(baci_file, index=False)
+    PRO = PRO.drop('E')
+    region_mapping['XX'] = [12]
+
+    def run(out_dir, hs_mapping, batch_size):
+        mapping_dir = tmp_path/'mapping'
+        mapping_dir.mkdir(exist_ok=True)
+        with open(str(mapping_dir/'ecoinvent35-HS12_mapping.json'), 'w') as fh:
+            json.dump(hs_mapping, fh)
+        with open(str(mapping_dir/'ecoinvent35-baci_region_mapping.json'), 'w') as fh:
+            json.dump(region_mapping, fh)
+        return match.Match_BACI_data_to_ecoinvent(
+                PRO, baci_file, outputDir=str(out_dir), USD_EURO_exr=1.2,
+                Nsamples=20, mapping_data_dir=str(mapping_dir),
+                batch_size=batch_size, output='both', seed=11,
+                instrumentation=False)
+
+    changed = dict(eco_HS12_mapping, B=['030130'], D=['010110'])
+    run(tmp_path/'incremental', eco_HS12_mapping, 1)
+    status = run(tmp_path/'incremental', changed, 1)
+    assert status == {'A': 'ok', 'B': 'ok', 'C': 'ok', 'D': 'ok'}
+    run(tmp_path/'fresh', changed, 50)
+    names = sorted(os.listdir(str(tmp_path/'fresh')))
+    assert names == sorted(os.listdir(str(tmp_path/'incremental')))
+    assert 'baci_price_samples.npy' in names and 'B.pickle' in names
+    for name in names:
+        assert (tmp_path/'incremental'/name).read_bytes() == \
+            (tmp_path/'fresh'/name).read_bytes(), name
+
+
+def test_scenarios(tmp_path, PRO, mappings, ray_session):
+    """Exchange rate scenarios of a BACI file are rescalings of each other,
+    and every scenario has the samples of a single match with the same
+    seed."""
+    mapping_dir = tmp_path/'mapping'
+    mapping_dir.mkdir()
+    region_mapping, eco_HS12_mapping = mappings
+    with open(str(mapping_dir/'ecoinvent35-HS12_mapping.json'), 'w') as fh:
+        json.dump(eco_HS12_mapping, fh)
+    with open(str(mapping_dir/'ecoinvent35-baci_region_mapping.json'), 'w') as fh:
+        json.dump(region_mapping, fh)
+    rng = np.random.default_rng(3)
+    baci_files = []
+    for year in (2012, 2013):
+        baci_files.append(str(tmp_path/'baci_{}.csv'.format(year)))
+        pd.DataFrame({'t': year, 'i': rng.choice([4, 8], 200),
+                      'j': rng.choice([4, 8, 12], 200),
+                      'k': rng.choice(['010110', '020120'], 200),
+                      'v': rng.lognormal(size=200), 'q': rng.random(200)}
+                     ).to_csv(baci_files[-1], index=False)
+    kwargs = dict(Nsamples=30, mapping_data_dir=str(mapping_dir), seed=5,
+                  instrumentation=False)
+    scenarios = {'2012_low': (baci_files[0], 1.1),
+                 '2012_high': (baci_files[0], 1.4),
+                 '2013': (baci_files[1], 1.2)}
+    statuses = match.Match_BACI_scenarios_to_ecoinvent(
+            PRO, scenarios, outputDir=str(tmp_path/'scenarios'),
+            batch_size=1, **kwargs)
+    assert statuses['2013'] == {'A': 'ok', 'B': 'ok', 'C': 'ok',
+                                'D': 'no region'}
+
+    def read(out_dir):
+        return (np.load(str(out_dir/'baci_price_samples.npy')),
+                pd.read_feather(str(out_dir/'baci_price_summary.ftr')))
+
+    low, low_summary = read(tmp_path/'scenarios'/'2012_low')
+    high, high_summary = read(tmp_path/'scenarios'/'2012_high')
+    np.testing.assert_allclose(high*1.4, low*1.1, rtol=1e-12)
+    for column in ['price_baci_mean', 'price_baci_std', 'price_baci_min',
+                   'price_baci_max', 'price_percentile_50']:
+        np.testing.assert_allclose(high_summary[column]*1.4,
+                                   low_summary[column]*1.1, rtol=1e-12)
+    pd.testing.assert_series_equal(high_summary['nr_baci_flows'],
+                                   low_summary['nr_baci_flows'])
+
+    for name, (baci_file, exr) in scenarios.items():
+        out_dir = tmp_path/'single'/name
+        match.Match_BACI_data_to_ecoinvent(
+                PRO, baci_file, outputDir=str(out_dir), USD_EURO_exr=exr,
+                output='consolidated', **kwargs)
+        samples, summary = read(tmp_path/'scenarios'/name)
+        single_samples, single_summary = read(out_dir)
+        np.testing.assert_allclose(samples, single_samples, rtol=1e-12)
+        pd.testing.assert_frame_equal(summary, single_summary, rtol=1e-12)
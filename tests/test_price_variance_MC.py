@@ -0,0 +1,326 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from Price_Uncertainty_HLCA import price_variance_MC as pvm
+
+
+@pytest.fixture
+def system():
+    """Small hybrid system: 4 impacts, 30 IO sectors, 50 processes of which
+    every third one has a cut-off column, and 40 price samples."""
+    rng = np.random.default_rng(0)
+    n_io, n = 30, 50
+    M_io = scipy.sparse.random(4, n_io, density=.5, format='csr',
+                               random_state=1)
+    Cu = scipy.sparse.random(n_io, n, density=.1, format='csr', random_state=2)
+    Cu = scipy.sparse.csr_matrix(Cu.toarray()*(np.arange(n) % 3 == 0))
+    A_ff = scipy.sparse.random(n, n, density=.05, random_state=3)*0.1
+    A_lca = scipy.sparse.identity(n, format='csc') - A_ff
+    Lp = np.linalg.inv(A_lca.toarray())
+    price_data = rng.lognormal(size=(n, 40))
+    return M_io, Lp, A_lca, Cu, price_data
+
+
+def baseline_price_MC(M_io, Lp, Cu, price_data, Nruns):
+    """The run by run loop of the original do_price_MC."""
+    results = np.zeros((M_io.shape[0], Lp.shape[1], Nruns))
+    for i in range(Nruns):
+        Cu_sample = Cu.multiply(price_data[:, i])
+        results[:, :, i] = M_io.dot(Cu_sample).dot(Lp)
+    return results
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse', 'solver'])
+def test_MC_block_matches_baseline(system, kind):
+    M_io, Lp, A_lca, Cu, price_data = system
+    expected = baseline_price_MC(M_io, Lp, Cu, price_data, 12)
+    if kind == 'dense':
+        MCu, Lp_active, active = pvm.prepare_MC_matrices(M_io, Lp, Cu)
+    elif kind == 'sparse':
+        MCu, Lp_active, active = pvm.prepare_MC_matrices(
+                M_io, scipy.sparse.csr_matrix(Lp), Cu)
+    else:
+        MCu, Lp_active, active = pvm.prepare_MC_matrices(M_io, None, Cu,
+                                                         A_lca=A_lca)
+        assert isinstance(Lp_active, pvm.LeontiefSolver)
+    block = pvm.MC_block(MCu, Lp_active, price_data[active, :12])
+    np.testing.assert_allclose(block, expected, rtol=1e-10,
+                               atol=1e-12*np.abs(expected).max())
+
+
+def test_do_price_MC_matches_baseline(system):
+    M_io, Lp, A_lca, Cu, price_data = system
+    expected = baseline_price_MC(M_io, Lp, Cu, price_data, 37)
+    dense = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=37, block_size=8,
+                            instrumentation=False)
+    solved = pvm.do_price_MC(M_io, None, Cu, price_data, Nruns=37,
+                             block_size=8, A_lca=A_lca, instrumentation=False)
+    assert dense.shape == (4, 50, 37)
+    np.testing.assert_allclose(dense, expected, rtol=1e-5,
+                               atol=1e-6*np.abs(expected).max())
+    np.testing.assert_allclose(solved, dense, rtol=1e-5,
+                               atol=1e-6*np.abs(expected).max())
+
+
+def test_statistics_only_matches_full_results(system):
+    M_io, Lp, A_lca, Cu, price_data = system
+    full = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=40, block_size=7,
+                           instrumentation=False).astype('float64')
+    stats = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=40, block_size=7,
+                            statistics_only=True, percentiles=(10, 50, 90),
+                            impact_names=['a', 'b', 'c', 'd'],
+                            instrumentation=False)
+    assert stats['Nruns'] == 40
+    assert stats['impact_names'] == ['a', 'b', 'c', 'd']
+    scale = np.abs(full).max()
+    np.testing.assert_allclose(stats['mean'], full.mean(axis=-1), atol=1e-6*scale)
+    np.testing.assert_allclose(stats['std'], full.std(axis=-1), atol=1e-6*scale)
+    np.testing.assert_allclose(stats['min'], full.min(axis=-1), atol=1e-6*scale)
+    np.testing.assert_allclose(stats['max'], full.max(axis=-1), atol=1e-6*scale)
+    assert stats['percentiles'].shape == (4, 50, 3)
+    np.testing.assert_array_equal(stats['percentile_levels'], [10, 50, 90])
+
+
+def test_MCStatistics_matches_numpy():
+    rng = np.random.default_rng(1)
+    runs = rng.standard_normal((2, 3, 5000))
+    stats = pvm.MCStatistics((2, 3))
+    for start, stop in [(0, 3), (3, 500), (500, 1234), (1234, 5000)]:
+        stats.update(runs[:, :, start:stop])
+    summary = stats.summary()
+    assert summary['Nruns'] == 5000
+    np.testing.assert_allclose(summary['mean'], runs.mean(axis=-1))
+    np.testing.assert_allclose(summary['std'], runs.std(axis=-1))
+    np.testing.assert_array_equal(summary['min'], runs.min(axis=-1))
+    np.testing.assert_array_equal(summary['max'], runs.max(axis=-1))
+    # The P-square estimates are approximate
+    expected = np.moveaxis(np.percentile(runs, [2.5, 16, 50, 84, 97.5],
+                                         axis=-1), 0, -1)
+    np.testing.assert_allclose(summary['percentiles'], expected, atol=0.1)
+
+
+def test_MCStatistics_few_runs_exact():
+    runs = np.random.default_rng(2).standard_normal((1, 2, 6))
+    stats = pvm.MCStatistics((1, 2))
+    stats.update(runs)
+    np.testing.assert_allclose(
+            stats.percentile_values(),
+            np.percentile(runs, [2.5, 16, 50, 84, 97.5], axis=-1))
+
+
+def test_store_resumes_interrupted_run(system, tmp_path):
+    M_io, Lp, A_lca, Cu, price_data = system
+    store_dir = str(tmp_path/'store')
+    names = ['a', 'b', 'c', 'd']
+    index = ['p{}'.format(j) for j in range(50)]
+    kwargs = dict(Nruns=40, block_size=7, store_dir=store_dir,
+                  impact_names=names, process_index=index,
+                  process_chunk_size=12, instrumentation=False)
+    full = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=40, block_size=7,
+                           instrumentation=False)
+    pvm.do_price_MC(M_io, Lp, Cu, price_data, **kwargs)
+    np.testing.assert_array_equal(pvm.read_MC_results(store_dir), full)
+    np.testing.assert_array_equal(
+            pvm.read_MC_results(store_dir, processes=['p3', 'p40'],
+                                runs=(5, 23), impacts=['d', 'b']),
+            full[[3, 1]][:, [3, 40]][:, :, 5:23])
+
+    # Interrupt: only the first three run chunks were completed and a chunk
+    # file of a later one is missing
+    metadata = pvm.read_MC_metadata(store_dir)
+    metadata['completed_run_chunks'] = [0, 1, 2]
+    with open(os.path.join(store_dir, 'metadata.json'), 'w') as fh:
+        json.dump(metadata, fh)
+    os.remove(os.path.join(store_dir, 'runs_00004_processes_00002.npy'))
+    with pytest.raises(Exception):
+        pvm.read_MC_results(store_dir)
+    pvm.do_price_MC(M_io, Lp, Cu, price_data, **kwargs)
+    np.testing.assert_array_equal(pvm.read_MC_results(store_dir), full)
+    assert pvm.read_MC_metadata(store_dir)['completed_run_chunks'] == list(range(6))
+
+
+@pytest.mark.parametrize('change', [{'seed': 3}, {'sampling': 'random'},
+                                    {'prices': 1.01}])
+def test_store_rejects_other_problem(system, tmp_path, change):
+    M_io, Lp, A_lca, Cu, price_data = system
+    store_dir = str(tmp_path/'store')
+    pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=20, block_size=7,
+                    store_dir=store_dir, instrumentation=False)
+    prices = price_data*change.pop('prices', 1)
+    with pytest.raises(Exception, match='different problem'):
+        pvm.do_price_MC(M_io, Lp, Cu, prices, Nruns=20, block_size=7,
+                        store_dir=store_dir, instrumentation=False, **change)
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse', 'solver'])
+def test_parallel_runs_match_serial(system, kind, ray_session):
+    M_io, Lp, A_lca, Cu, price_data = system
+    if kind == 'sparse':
+        Lp = scipy.sparse.csr_matrix(Lp)
+    elif kind == 'solver':
+        Lp = None
+    kwargs = dict(Nruns=40, block_size=7, A_lca=A_lca, instrumentation=False)
+    serial = pvm.do_price_MC(M_io, Lp, Cu, price_data, **kwargs)
+    parallel = pvm.do_price_MC(M_io, Lp, Cu, price_data, n_cores=2, **kwargs)
+    np.testing.assert_array_equal(parallel, serial)
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse', 'solver'])
+def test_processes_selection(system, kind):
+    M_io, Lp, A_lca, Cu, price_data = system
+    full = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=20, block_size=7,
+                           instrumentation=False)
+    if kind == 'sparse':
+        Lp = scipy.sparse.csr_matrix(Lp)
+    elif kind == 'solver':
+        Lp = None
+    index = ['p{}'.format(j) for j in range(50)]
+    selected = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=20,
+                               block_size=7, A_lca=A_lca,
+                               process_index=index,
+                               processes=['p7', 'p0', 'p33'],
+                               instrumentation=False)
+    np.testing.assert_allclose(selected, full[:, [7, 0, 33]], rtol=1e-5,
+                               atol=1e-6*np.abs(full).max())
+    positions = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=20,
+                                block_size=7, A_lca=A_lca, processes=[7, 0, 33],
+                                instrumentation=False)
+    np.testing.assert_array_equal(positions, selected)
+
+
+def test_price_MC_moments(system):
+    M_io, Lp, A_lca, Cu, price_data = system
+    index = ['p{}'.format(j) for j in range(50)]
+    moments = pvm.price_MC_moments(M_io, Lp, Cu, price_data,
+                                   process_index=index, contributions=True,
+                                   block_size=4, instrumentation=False)
+    # Analytic formula with the full M_io.dot(Cu)
+    MCu = M_io.dot(Cu).toarray()
+    mean = (MCu*price_data.mean(axis=1)).dot(Lp)
+    var = (MCu**2*price_data.var(axis=1)).dot(Lp**2)
+    np.testing.assert_allclose(moments['mean'], mean)
+    np.testing.assert_allclose(moments['var'], var)
+    np.testing.assert_allclose(moments['contributions'].sum(axis=1), var)
+    # All prices vary, so every process with a cut-off column contributes
+    varying = np.flatnonzero(np.diff(scipy.sparse.csc_matrix(Cu).indptr))
+    assert moments['contribution_process_index'] == [index[j] for j in varying]
+
+    # A long MC with independently sampled prices converges to the moments
+    runs = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=20000,
+                           block_size=2000, sampling='random', seed=4,
+                           instrumentation=False).astype('float64')
+    np.testing.assert_allclose(runs.mean(axis=-1), mean, rtol=0.02,
+                               atol=1e-9)
+    np.testing.assert_allclose(runs.var(axis=-1), var, rtol=0.1, atol=1e-9)
+
+    selected = pvm.price_MC_moments(M_io, None, Cu, price_data, A_lca=A_lca,
+                                    process_index=index, processes=['p3', 'p9'],
+                                    contributions=True, instrumentation=False)
+    np.testing.assert_allclose(selected['var'], var[:, [3, 9]])
+    assert selected['process_index'] == ['p3', 'p9']
+    assert (selected['contribution_process_index'] ==
+            moments['contribution_process_index'])
+
+
+@pytest.mark.parametrize('method', ['random', 'lhs', 'sobol'])
+def test_sampler_independent_of_block_size(method):
+    price_data = np.random.default_rng(5).lognormal(size=(20, 16))
+    price_data[3] = 2.
+    whole = pvm.PriceSampler(price_data, method=method, Nruns=16,
+                             seed=9).block(0, 16)
+    sampler = pvm.PriceSampler(price_data, method=method, Nruns=16, seed=9)
+    blocks = np.hstack([sampler.block(i, min(i+5, 16))
+                        for i in range(0, 16, 5)])
+    np.testing.assert_array_equal(whole, blocks)
+    assert (whole[3] == 2.).all()
+
+
+def test_lhs_takes_every_stratum_once():
+    # With as many runs as samples every stratum holds exactly one sample
+    price_data = np.random.default_rng(6).lognormal(size=(30, 200))
+    sampler = pvm.PriceSampler(price_data, method='lhs', Nruns=200, seed=2)
+    block = sampler.block(0, 200)
+    np.testing.assert_array_equal(np.sort(block, axis=1),
+                                  np.sort(price_data, axis=1))
+    # and each process visits the strata in its own order
+    ranks = np.argsort(np.argsort(block, axis=1), axis=1)
+    assert len(np.unique(ranks, axis=0)) == len(ranks)
+
+
+def test_convergence_stops_early(system):
+    M_io, Lp, A_lca, Cu, price_data = system
+    kwargs = dict(Nruns=3000, block_size=100, sampling='random', seed=4,
+                  instrumentation=False)
+    full = pvm.do_price_MC(M_io, Lp, Cu, price_data, **kwargs)
+    results, convergence = pvm.do_price_MC(
+            M_io, Lp, Cu, price_data, convergence_rtol=0.1, check_every=300,
+            stable_fraction=0.8, **kwargs)
+    n = convergence['Nruns']
+    assert convergence['converged'] and n < 3000
+    assert [c['Nruns'] for c in convergence['trace']] == list(range(300, n+1, 300))
+    assert convergence['trace'][-1]['stable_fraction'] >= 0.8
+    np.testing.assert_array_equal(results, full[:, :, :n])
+
+    # statistics_only checks the P-square estimates instead
+    summary, convergence = pvm.do_price_MC(
+            M_io, Lp, Cu, price_data, convergence_rtol=0.1, check_every=300,
+            stable_fraction=0.8, statistics_only=True, **kwargs)
+    assert convergence['converged']
+    assert summary['Nruns'] == convergence['Nruns']
+
+
+def test_store_full_run_after_converged_run(system, tmp_path):
+    M_io, Lp, A_lca, Cu, price_data = system
+    store_dir = str(tmp_path/'store')
+    kwargs = dict(Nruns=3000, block_size=100, sampling='random', seed=4,
+                  store_dir=store_dir, instrumentation=False)
+    metadata, convergence = pvm.do_price_MC(
+            M_io, Lp, Cu, price_data, convergence_rtol=0.1, check_every=300,
+            stable_fraction=0.8, **kwargs)
+    assert convergence['converged']
+    assert metadata['converged_Nruns'] == convergence['Nruns']
+    assert pvm.read_MC_results(store_dir).shape[-1] == convergence['Nruns']
+
+    pvm.do_price_MC(M_io, Lp, Cu, price_data, **kwargs)
+    assert 'converged_Nruns' not in pvm.read_MC_metadata(store_dir)
+    full = pvm.do_price_MC(M_io, Lp, Cu, price_data, Nruns=3000,
+                           block_size=100, sampling='random', seed=4,
+                           instrumentation=False)
+    np.testing.assert_array_equal(pvm.read_MC_results(store_dir), full)
+
+
+def test_impacts_selection(system, tmp_path):
+    M_io, Lp, A_lca, Cu, price_data = system
+    names = ['a', 'b', 'c', 'd']
+    index = ['p{}'.format(j) for j in range(50)]
+    kwargs = dict(Nruns=12, block_size=5, instrumentation=False)
+    full = pvm.do_price_MC(M_io, Lp, Cu, price_data, impact_names=names,
+                           process_index=index, **kwargs)
+    assert isinstance(full, pvm.MCResults)
+    assert full.impact_names == names and full.process_index == index
+    by_name = pvm.do_price_MC(M_io, Lp, Cu, price_data, impact_names=names,
+                              process_index=index, impacts=['d', 'b'],
+                              processes=['p7', 'p3'], **kwargs)
+    np.testing.assert_allclose(by_name, full[[3, 1]][:, [7, 3]], rtol=1e-6)
+    assert by_name.impact_names == ['d', 'b']
+    assert by_name.process_index == ['p7', 'p3']
+    by_position = pvm.do_price_MC(M_io, Lp, Cu, price_data, impacts=[3, 1],
+                                  **kwargs)
+    np.testing.assert_array_equal(by_position, full[[3, 1]])
+    assert by_position.impact_names == [3, 1]
+    assert by_position.process_index is None
+    # Labels are not carried over to derived arrays
+    assert full[1:].impact_names is None
+
+    store_dir = str(tmp_path/'store')
+    metadata = pvm.do_price_MC(M_io, Lp, Cu, price_data, impact_names=names,
+                               process_index=index, impacts=['c'],
+                               store_dir=store_dir, **kwargs)
+    assert metadata['impact_names'] == ['c']
+    stored = pvm.read_MC_results(store_dir, processes=['p9'])
+    np.testing.assert_array_equal(stored, full[[2]][:, [9]])
+    assert stored.impact_names == ['c'] and stored.process_index == ['p9']
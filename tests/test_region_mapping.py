@@ -0,0 +1,76 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Price_Uncertainty_HLCA import region_mapping
+
+
+class StubConcordance:
+    """Stands in for the region concordance of cutoffmatrix, counting the
+    calls of CountryList and RoW."""
+    regionExceptions = {'US-TX': 'US'}
+    regions = {'RER': ['CH', 'DE'], 'RXX': ['CH', 'XX'],
+               'WORLD': ['CH', 'DE', 'US', 'NA']}
+
+    def __init__(self):
+        self.calls = 0
+
+    def CountryList(self, region):
+        self.calls += 1
+        return self.regions[region]
+
+    def RoW(self, excluded):
+        self.calls += 1
+        return [c for c in self.regions['WORLD'] if c not in excluded]
+
+
+@pytest.fixture
+def resolver(tmp_path):
+    country_codes = str(tmp_path/'country_codes_baci.csv')
+    pd.DataFrame({'CODE': [756, 276, 842, 516, 577],
+                  'IN_BACI': [1, 1, 1, 0, 1]}).to_csv(country_codes, index=False)
+    country_mapping = pd.DataFrame(
+            {'Code_eco': ['CH', 'DE', 'US', 'NA', 'NA', 'AQ'],
+             'CODE_BACI': [756, 276, 842, 516, 577, np.nan]})
+    return region_mapping.RegionResolver(country_codes, country_mapping,
+                                         RC=StubConcordance())
+
+
+def test_eco2BACI_region(resolver):
+    assert resolver.eco2BACI_region('CH') == [756]
+    # Namibia is listed in BACI but only its Africa NES code is in the data
+    assert resolver.eco2BACI_region('NA') == [577]
+    assert resolver.eco2BACI_region('US-TX') == [842]
+    assert resolver.eco2BACI_region('RER') == [756, 276]
+    assert resolver.eco2BACI_region('RoW', excluded=['DE', 'US']) == [756, 577]
+    assert resolver.eco2BACI_region('GLO') == [756, 276, 842, 577]
+    assert resolver.eco2BACI_region('RoW') == [756, 276, 842, 577]
+    with pytest.raises(NameError):
+        resolver.eco2BACI_region(float('nan'))
+    with pytest.raises(KeyError):
+        resolver.eco2BACI_region('UNKNOWN')
+    with pytest.raises(KeyError):
+        resolver.eco2BACI_region('RXX')
+
+
+def test_eco2BACI_region_cache(resolver):
+    first = resolver.eco2BACI_region('RoW', excluded=['DE', 'US'])
+    first.append(0)
+    assert resolver.eco2BACI_region('RoW', excluded=['US', 'DE']) == [756, 577]
+    assert resolver.eco2BACI_region('RER') == [756, 276]
+    resolver.eco2BACI_region('RER')
+    assert resolver.RC.calls == 2
+
+
+def test_create_eco_baci_geography_mapping(resolver):
+    PRO = pd.DataFrame({'geography': ['CH', 'CH', 'RoW', 'RER']},
+                       index=['a_x', 'b_x', 'c_x', 'd_x'])
+    excluded = {'c': ['CH', 'NA']}
+    resolver._cm = types.SimpleNamespace(
+            GetEcoRegion=lambda proc, prod, PRO: (PRO.loc[proc + '_' + prod,
+                                                          'geography'],
+                                                  excluded.get(proc)))
+    assert region_mapping.create_eco_baci_geography_mapping(PRO, resolver) == {
+            'CH': [756], 'c_x': [276, 842], 'RER': [756, 276]}